@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 from __future__ import absolute_import, unicode_literals
+import bz2
 from itertools import groupby
+import gzip
+import hashlib
+import json
+import mmap
 import mwparserfromhell
+import os
+from queue import Queue
 import re
+import struct
+import sys
+import time
 
 import pywikibot
 from pywikibot import pagegenerators
+from pywikibot.data import api
 
-from pywikibot.bot import (
-    SingleSiteBot, ExistingPageBot, NoRedirectPageBot, AutomaticTWSummaryBot)
-from pywikibot.tools import issue_deprecation_warning
+# The base shared by every task is kept at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fireflybot import FireflyBot
 
 """
 Bot script to update the article counts and assessments at [[Wikipedia:Vital articles]]
@@ -27,6 +38,45 @@ The following parameters are supported:
 -top              Place additional text on top of the page
 
 -summary:         Set the action summary message for the edit.
+
+-record:          Record every API request and response to this cassette file
+
+-replay:          Answer API requests from this cassette file instead of the
+                  wiki, as recorded with -record
+
+-metrics:         Write the time spent in each phase of the run, and counts of
+                  API requests, bytes received, retries and cache hits, to
+                  this JSON file
+
+-prometheus:      Write the same totals to this file in the Prometheus text
+                  format
+
+-stream           Keep running, checking talk pages as they are created
+
+-checkpoint:      With -stream, remember in this JSON file how far through
+                  recent changes the bot has got, and carry on from there
+                  when it is started again
+
+-interval:        With -stream, seconds to wait between checks for new talk
+                  pages; 60 by default
+
+-titleindex:      Look up subject pages in this title index before asking the
+                  wiki. Only subject pages missing from the index, which may
+                  have been created since its dump, are looked up on the wiki
+
+-buildtitleindex: Build the -titleindex file from this all-titles dump (e.g.
+                  enwiki-20240101-all-titles.gz) and exit
+
+-bloom            With -buildtitleindex, add a Bloom filter to the index so
+                  titles that aren't in it are ruled out faster
+
+-shards:          Split the talk namespaces into this many groups and list the
+                  new pages in each group at the same time
+
+-maxrate:         The most API requests to make per second, across all threads
+                  and every task run in the same process; 10 by default with
+                  -shards. Requests are always slowed down for a while when
+                  the wiki reports lag
 """
 #
 # (C) Pywikibot team, 2006-2018
@@ -42,78 +92,242 @@ docuReplacements = {
 }
 
 
-class FireflyBot(
-    SingleSiteBot,  # A bot only working on one site
-    ExistingPageBot,  # CurrentPageBot which only treats existing pages
-    NoRedirectPageBot,  # CurrentPageBot which only treats non-redirects
-):
-    def __init__(self, generator, **kwargs):
+class TitleIndex(object):
+    """
+    A compact, memory-mapped index of the page titles in an all-titles dump.
+
+    Titles are kept per namespace in sorted blocks. Each title in a block is
+    stored as the length of the prefix it shares with the one before and the
+    rest of its UTF-8 bytes, so the index is a fraction of the dump's size.
+    A lookup binary searches the blocks by their first title and then reads
+    one block. An optional Bloom filter answers most lookups for titles
+    that aren't there without touching the blocks.
+
+    The file is laid out as a magic string, the blocks, each namespace's
+    block offsets, the Bloom filter, a JSON header, and finally the header's
+    offset and length.
+    """
+
+    magic = b"TITLEIDX"
+    block_size = 64
+
+    def __init__(self, filename):
         """
         Constructor.
 
-        @param generator: the page generator that determines on which pages
-            to work
-        @type generator: generator
+        @param filename: path of an index made by TitleIndex.build
+        @type filename: unicode
         """
-        # Add your own options to the bot and set their defaults
-        # -always option is predefined by BaseBot class
-        self.availableOptions.update({
-            'replace': False,  # delete old text and write the new text
-            'summary': None,  # your own bot summary
-            'text': 'Test',  # add this text from option. 'Test' is default
-            'top': False,  # append text on top of the page
-        })
-        
-        self.task_number = -1
-        self.check_page = "User:Bot0612/shutoff/{}"
-
-        # call constructor of the super class
-        super(FireflyBot, self).__init__(site=True, **kwargs)
-
-        # handle old -dry parameter
-        self._handle_dry_param(**kwargs)
-
-        # assign the generator to the bot
-        self.generator = generator
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(self.magic)] != self.magic:
+            raise ValueError("{} is not a title index".format(filename))
+        header_offset, header_length = struct.unpack("<QQ", self.data[-16:])
+        header = json.loads(self.data[header_offset:header_offset + header_length].decode("utf-8"))
+        self.timestamp = header["timestamp"]
+        self.namespaces = {}
+        for namespace, info in header["namespaces"].items():
+            offsets = memoryview(self.data)[info["offsets"]:info["offsets"] + 8 * info["blocks"]].cast("Q")
+            self.namespaces[int(namespace)] = offsets
+        self.bloom = None
+        if header["bloom"] is not None:
+            self.bloom = memoryview(self.data)[header["bloom"]["offset"]:header["bloom"]["offset"] + header["bloom"]["bits"] // 8]
+            self.bloom_bits = header["bloom"]["bits"]
+            self.bloom_hashes = header["bloom"]["hashes"]
+
+    @staticmethod
+    def key(title):
+        # Titles are stored as they are in the dump, with underscores for spaces
+        return title.replace(" ", "_").encode("utf-8")
+
+    @staticmethod
+    def bloom_positions(namespace, key, bits, hashes):
+        digest = hashlib.blake2b(str(namespace).encode("ascii") + b"\0" + key, digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % bits for i in range(hashes)]
+
+    @staticmethod
+    def write_varint(f, number):
+        while number >= 0x80:
+            f.write(bytes((number & 0x7f | 0x80,)))
+            number >>= 7
+        f.write(bytes((number,)))
+
+    def read_varint(self, offset):
+        number = 0
+        shift = 0
+        while True:
+            byte = self.data[offset]
+            offset += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number, offset
+            shift += 7
+
+    # Whether the index was built with the namespace in it. Lookups in other
+    # namespaces have to go to the wiki
+    def covers(self, namespace):
+        return int(namespace) in self.namespaces
+
+    def contains(self, namespace, title):
+        offsets = self.namespaces[int(namespace)]
+        key = self.key(title)
+        if self.bloom is not None:
+            for position in self.bloom_positions(int(namespace), key, self.bloom_bits, self.bloom_hashes):
+                if not self.bloom[position >> 3] & (1 << (position & 7)):
+                    return False
+
+        # Find the last block whose first title is at or before the key
+        low, high = 0, len(offsets)
+        while low < high:
+            middle = (low + high) // 2
+            count, offset = self.read_varint(offsets[middle])
+            length, offset = self.read_varint(offset)
+            if self.data[offset:offset + length] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return False
+
+        count, offset = self.read_varint(offsets[low - 1])
+        title = b""
+        for i in range(count):
+            shared = 0
+            if i > 0:
+                shared, offset = self.read_varint(offset)
+            length, offset = self.read_varint(offset)
+            title = title[:shared] + self.data[offset:offset + length]
+            offset += length
+            if title >= key:
+                return title == key
+        return False
 
-    def check_task_switch_is_on(self):
-        if self.task_number == -2: # Operator userspace only tasks
-            return True 
-        check_page = pywikibot.Page(self.site, self.check_page.format(self.task_number))
-        return (check_page.text.strip() == "active")
-        
-    def _handle_dry_param(self, **kwargs):
+    def close(self):
+        self.namespaces = {}
+        self.bloom = None
+        self.data.close()
+        self.file.close()
+
+    @staticmethod
+    def read_dump(dump, namespaces):
+        opener = gzip.open if dump.endswith(".gz") else bz2.open if dump.endswith(".bz2") else open
+        with opener(dump, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if "\t" in line:
+                    namespace, title = line.split("\t", 1)
+                    if not namespace.isdigit():  # The header line
+                        continue
+                    namespace = int(namespace)
+                else:  # The all-titles-in-ns0 dumps have no namespace column
+                    namespace, title = 0, line
+                if namespaces is None or namespace in namespaces:
+                    yield namespace, title
+
+    @classmethod
+    def build(cls, dump, filename, namespaces=None, bloom_bits_per_title=0):
         """
-        Read the dry parameter and set the simulate variable instead.
-
-        This is a private method. It prints a deprecation warning for old
-        -dry paramter and sets the global simulate variable and informs
-        the user about this setting.
-
-        The constuctor of the super class ignores it because it is not
-        part of self.availableOptions.
-
-        @note: You should ommit this method in your own application.
-
-        @keyword dry: deprecated option to prevent changes on live wiki.
-            Use -simulate instead.
-        @type dry: bool
+        Build an index from an all-titles dump, sorted by namespace and title.
+
+        @param dump: path of the dump, which may be gzip or bzip2 compressed
+        @type dump: unicode
+        @param filename: path to write the index to
+        @type filename: unicode
+        @param namespaces: namespaces to index; all of them by default
+        @type namespaces: list of int
+        @param bloom_bits_per_title: size of the Bloom filter; 10 bits per title
+            gives about 1% false positives. 0 leaves it out
+        @type bloom_bits_per_title: int
         """
-        if 'dry' in kwargs:
-            issue_deprecation_warning('dry argument',
-                                      'pywikibot.config.simulate', 1)
-            # use simulate variable instead
-            pywikibot.config.simulate = True
-            pywikibot.output('config.simulate was set to True')
+        match = re.search(r"-(\d{4})(\d\d)(\d\d)-", os.path.basename(dump))
+        if match:
+            timestamp = "{}-{}-{}T00:00:00Z".format(*match.groups())
+        else:
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(os.path.getmtime(dump)))
+
+        header = {"timestamp": timestamp, "namespaces": {}, "bloom": None}
+        total = 0
+        with open(filename, "wb") as f:
+            f.write(cls.magic)
+            block_offsets = {}
+            previous_namespace = None
+            previous = None
+            block = []
+
+            def write_block():
+                block_offsets[previous_namespace].append(f.tell())
+                cls.write_varint(f, len(block))
+                last = b""
+                for i, key in enumerate(block):
+                    shared = 0
+                    if i > 0:
+                        while shared < min(len(last), len(key)) and last[shared] == key[shared]:
+                            shared += 1
+                        cls.write_varint(f, shared)
+                    cls.write_varint(f, len(key) - shared)
+                    f.write(key[shared:])
+                    last = key
+                del block[:]
+
+            for namespace, title in cls.read_dump(dump, namespaces):
+                key = cls.key(title)
+                if namespace != previous_namespace:
+                    if block:
+                        write_block()
+                    if namespace in block_offsets:
+                        raise ValueError("The dump must be sorted by namespace and title")
+                    block_offsets[namespace] = []
+                    previous_namespace = namespace
+                    previous = None
+                elif key <= previous:
+                    if key == previous:
+                        continue
+                    raise ValueError("The dump must be sorted by namespace and title")
+                block.append(key)
+                previous = key
+                total += 1
+                if len(block) == cls.block_size:
+                    write_block()
+            if block:
+                write_block()
+
+            for namespace, offsets in block_offsets.items():
+                header["namespaces"][str(namespace)] = {"offsets": f.tell(), "blocks": len(offsets)}
+                f.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+
+            if bloom_bits_per_title:
+                # A second pass over the dump, now that the number of titles is known
+                bits = max(64, (total * bloom_bits_per_title + 63) // 64 * 64)
+                hashes = max(1, int(round(bloom_bits_per_title * 0.693)))
+                bloom = bytearray(bits // 8)
+                for namespace, title in cls.read_dump(dump, namespaces):
+                    for position in cls.bloom_positions(namespace, cls.key(title), bits, hashes):
+                        bloom[position >> 3] |= 1 << (position & 7)
+                header["bloom"] = {"offset": f.tell(), "bits": bits, "hashes": hashes}
+                f.write(bloom)
+
+            header_offset = f.tell()
+            header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+            f.write(header_bytes)
+            f.write(struct.pack("<QQ", header_offset, len(header_bytes)))
+        return total
 
-    def treat_page(self):
-        pass
 
 class G8PatrolBot(FireflyBot):
+    has_task_switch = False  # Operator userspace only tasks
+
+    # User talk pages (namespace 3) are left out, as G8 doesn't apply to them
+    talk_namespaces = [1, 5, 7, 9, 11, 13, 15, 101, 109, 119, 447, 711, 829, 2301, 2303]
 
     def __init__(self, generator, **kwargs):
         self.availableOptions.update({
-                'verbose': False
+                'verbose': False,
+                'stream': False,  # keep checking new talk pages as they are created
+                'checkpoint': None,  # JSON file recording how far through recent changes the stream is
+                'interval': 60,  # seconds between checks for new talk pages when streaming
+                'titleindex': None,  # TitleIndex file to look subject pages up in first
+                'shards': 1,  # groups of namespaces to list new pages from at the same time
         })
 
         # call constructor of the super class
@@ -121,24 +335,210 @@ class G8PatrolBot(FireflyBot):
         self.task_number = -2
         self.verbose = self.options.get("verbose")
 
-    def treat_page(self):
-        corresponding_page = pywikibot.Page(self.site, self.current_page.title().split(":", 1)[1], self.current_page.namespace - 1)
-        if not coresponding_page.exists():
-            print("We have a bad talk page - {}".format(self.current_page.title()))
-        
+        self.pending = []  # (talk page title, subject page) still to be checked
+        self.bad_talk_pages = []
+
+        # How far through recent changes the stream has got: the timestamp of the last
+        # page creation seen, and the IDs of the changes seen with that timestamp.
+        # Without a checkpoint, the stream starts after the newest creation on the wiki
+        self.stream_timestamp = None
+        self.stream_rcids = set()
+        self.checkpoint = self.getOption("checkpoint")
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                checkpoint = json.load(f)
+            self.stream_timestamp = checkpoint["timestamp"]
+            self.stream_rcids = set(checkpoint["rcids"])
+
+        self.title_index = None
+        if self.getOption("titleindex"):
+            self.title_index = TitleIndex(self.getOption("titleindex"))
+            pywikibot.output("Using the title index of pages that existed at {}".format(self.title_index.timestamp))
+
+    def run(self):
+        if self.getOption("stream"):
+            self.generator = self.stream_new_talk_pages()
+        elif int(self.getOption("shards")) > 1:
+            self.generator = self.scan_shards(int(self.getOption("shards")))
+        super(G8PatrolBot, self).run()
+
+    @property
+    def request_threads(self):
+        return 1 if self.getOption("stream") else max(int(self.getOption("shards")), 1)
+
+    # Lists new pages from several groups of namespaces at once, each on its own
+    # thread, and merges them. All of their requests share the scheduler's rate limit
+    def scan_shards(self, shard_count):
+        self.scheduler.limit(float(self.getOption("maxrate") or 10))
+
+        queue = Queue(maxsize=self.title_batch_size)
+        finished = object()
+
+        def scan(namespaces):
+            try:
+                for page in pagegenerators.NewpagesPageGenerator(site=self.site, namespaces=namespaces):
+                    queue.put(page)
+            except Exception as e:  # Raised again on the bot's thread
+                queue.put(e)
+            queue.put(finished)
+
+        groups = [self.talk_namespaces[i::shard_count] for i in range(shard_count)]
+        for namespaces in groups:
+            self.start_thread(scan, "G8PatrolBot shard {}".format(namespaces), namespaces)
+
+        seen = set()
+        running = len(groups)
+        while running:
+            item = queue.get()
+            if item is finished:
+                running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            if item.title() in seen:
+                continue
+            seen.add(item.title())
+            yield item
+
+    # Yields talk pages as they are created, polling recent changes every interval.
+    # Each poll's pages are checked as one batch before the checkpoint is saved
+    def stream_new_talk_pages(self):
+        if self.stream_timestamp is None:
+            self.stream_timestamp, self.stream_rcids = self.latest_creations()
+        while True:
+            parameters = {
+                "action": "query",
+                "list": "recentchanges",
+                "rctype": "new",
+                "rcnamespace": self.talk_namespaces,
+                "rcprop": "title|ids|timestamp",
+                "rcdir": "newer",
+                "rcstart": self.stream_timestamp,  # Changes at this time are included again, hence stream_rcids
+                "rclimit": "max",
+            }
+            while True:
+                data = api.Request(site=self.site, parameters=parameters).submit()
+                for change in data["query"]["recentchanges"]:
+                    if change["timestamp"] == self.stream_timestamp:
+                        if change["rcid"] in self.stream_rcids:
+                            continue
+                    else:
+                        self.stream_timestamp = change["timestamp"]
+                        self.stream_rcids = set()
+                    self.stream_rcids.add(change["rcid"])
+                    yield pywikibot.Page(self.site, change["title"])
+                if "continue" not in data:
+                    break
+                parameters.update(data["continue"])
+
+            self.check_pending()
+            self.save_checkpoint()
+            time.sleep(float(self.getOption("interval")))
+
+    # Gets the timestamp of the newest talk page creations and their change IDs.
+    # The wiki is asked rather than the clock read, so a recorded stream replays
+    def latest_creations(self):
+        data = api.Request(site=self.site, parameters={
+            "action": "query",
+            "list": "recentchanges",
+            "rctype": "new",
+            "rcnamespace": self.talk_namespaces,
+            "rcprop": "ids|timestamp",
+            "rcdir": "older",
+            "rclimit": 50,
+        }).submit()
+        changes = data["query"]["recentchanges"]
+        if not changes:  # Nothing created lately, so the whole recent changes feed is new
+            return "2001-01-15T00:00:00Z", set()
+        timestamp = changes[0]["timestamp"]
+        return timestamp, set(change["rcid"] for change in changes if change["timestamp"] == timestamp)
+
+    def save_checkpoint(self):
+        if not self.checkpoint or not self.getOption("stream") or self.stream_timestamp is None:
+            return
+        with open(self.checkpoint + ".tmp", "w") as f:
+            json.dump({"timestamp": self.stream_timestamp, "rcids": sorted(self.stream_rcids)}, f)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    # New talk pages are checked in bulk along with their subject pages in
+    # check_pending, rather than one request per page here
+    def skip_page(self, page):
+        return False
 
-def main(*args):
+    def treat_page(self):
+        self.pending.append((self.current_page.title(), self.current_page.toggleTalkPage()))
+        if len(self.pending) >= self.title_batch_size:
+            self.check_pending()
+
+    # Finds the buffered talk pages whose subject page doesn't exist, then checks
+    # that those talk pages themselves still exist and are not redirects
+    def check_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        # Subject pages in the title index existed when its dump was made, so only
+        # the rest need looking up
+        candidates = []
+        for talk_title, subject_page in pending:
+            namespace = subject_page.namespace()
+            if self.title_index is not None and self.title_index.covers(namespace) and \
+                    self.title_index.contains(namespace, subject_page.title(with_ns=False)):
+                self.metrics.count("title_index_hits")
+                continue
+            candidates.append((talk_title, subject_page.title()))
+
+        with self.metrics.phase("existence_check"):
+            missing, redirects = self.get_missing_and_redirects(subject_title for talk_title, subject_title in candidates)
+            # A redirect still counts as an existing subject page
+            talk_titles = [talk_title for talk_title, subject_title in candidates if subject_title in missing]
+            missing_talk, redirect_talk = self.get_missing_and_redirects(talk_titles)
+
+        # Talk pages that are gone or are redirects have already been deleted or moved
+        bad_talk_pages = [talk_title for talk_title in talk_titles if talk_title not in missing_talk and talk_title not in redirect_talk]
+
+        self.metrics.count("bad_talk_pages", len(bad_talk_pages))
+        for talk_title in bad_talk_pages:
+            print("We have a bad talk page - {}".format(talk_title))
+        self.bad_talk_pages.extend(bad_talk_pages)
+
+    # Looks up many titles at once. Returns the sets of those titles that don't
+    # exist and that are redirects
+    def get_missing_and_redirects(self, titles):
+        titles = set(titles)
+        normalised = {}
+        missing = set()
+        redirects = set()
+        for query in self.query_titles(titles, prop="info"):
+            normalised.update((item["to"], item["from"]) for item in query.get("normalized", []))
+            for page in query.get("pages", {}).values():
+                title = normalised.get(page["title"], page["title"])  # Back to the title that was asked for
+                if "missing" in page or "invalid" in page:
+                    missing.add(title)
+                elif "redirect" in page:
+                    redirects.add(title)
+        return missing, redirects
+
+    def teardown(self):
+        self.check_pending()
+        self.save_checkpoint()
+        print("{} bad talk pages found".format(len(self.bad_talk_pages)))
+        if self.title_index is not None:
+            self.title_index.close()
+        super(G8PatrolBot, self).teardown()
+
+
+def create_bot(*local_args):
     """
-    Process command line arguments and invoke bot.
-
-    If args is an empty list, sys.argv is used.
+    Process the bot's own command line arguments and create the bot.
 
-    @param args: command line arguments
-    @type args: list of unicode
+    @param local_args: command line arguments left over by
+        pywikibot.handle_args
+    @type local_args: list of unicode
+    @return: the bot, or None if there is no bot to run
+    @rtype: G8PatrolBot
     """
     options = {}
-    # Process global arguments to determine desired site
-    local_args = pywikibot.handle_args(args)
 
     # This factory is responsible for processing command line arguments
     # that are also used by other scripts and that determine on which pages
@@ -155,7 +555,7 @@ def main(*args):
         # Now pick up your own options
         arg, sep, value = arg.partition(':')
         option = arg[1:]
-        if option in ('summary', 'text'):
+        if option in ('summary', 'text', 'record', 'replay', 'metrics', 'prometheus', 'checkpoint', 'interval', 'titleindex', 'buildtitleindex', 'shards', 'maxrate'):
             if not value:
                 pywikibot.input('Please enter a value for ' + arg)
             options[option] = value
@@ -164,17 +564,43 @@ def main(*args):
         else:
             options[option] = True
 
+    build_dump = options.pop("buildtitleindex", None)
+    bloom = options.pop("bloom", False)
+    if build_dump:
+        if not options.get("titleindex"):
+            pywikibot.error("-buildtitleindex needs -titleindex: to say where to write the index")
+            return None
+        subject_namespaces = [namespace - 1 for namespace in G8PatrolBot.talk_namespaces]
+        count = TitleIndex.build(build_dump, options["titleindex"], subject_namespaces, 10 if bloom else 0)
+        pywikibot.output("Indexed {} titles".format(count))
+        return None
+
     # The preloading option is responsible for downloading multiple
-    # pages from the wiki simultaneously.
-    gen = pywikibot.pagegenerators.NewpagesPageGenerator(site=None, namespaces=[1,3,5,7,9,11,13,15,101,109,119,447,711,829,2301,2303]) 
+    # pages from the wiki simultaneously. With -stream the bot polls recent changes itself instead
+    gen = pywikibot.pagegenerators.NewpagesPageGenerator(site=None, namespaces=G8PatrolBot.talk_namespaces)
     if gen:
         # pass generator and private options to the bot
-        bot = G8PatrolBot(gen, **options)
-        bot.run()  # guess what it does
-        return True
+        return G8PatrolBot(gen, **options)
     else:
         pywikibot.bot.suggest_help(missing_generator=True)
+        return None
+
+
+def main(*args):
+    """
+    Process command line arguments and invoke bot.
+
+    If args is an empty list, sys.argv is used.
+
+    @param args: command line arguments
+    @type args: list of unicode
+    """
+    # Process global arguments to determine desired site
+    bot = create_bot(*pywikibot.handle_args(args))
+    if bot is None:
         return False
+    bot.run()  # guess what it does
+    return True
 
 
 if __name__ == '__main__':
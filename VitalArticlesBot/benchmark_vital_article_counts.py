@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+
+# The benchmark never talks to a wiki. pywikibot gets a user-config.py of its
+# own, in a directory that also takes its caches, and doesn't slow down between
+# requests or edits
+pywikibot_dir = tempfile.mkdtemp(prefix="vital-articles-benchmark-")
+with open(os.path.join(pywikibot_dir, "user-config.py"), "w") as f:
+    f.write("family = 'wikipedia'\nmylang = 'en'\nusernames['wikipedia']['en'] = 'StubBot'\n"
+            "put_throttle = 0\nminthrottle = 0\nmaxthrottle = 0\n")
+os.environ["PYWIKIBOT_DIR"] = pywikibot_dir
+os.environ.pop("PYWIKIBOT_NO_USER_CONFIG", None)
+# The stub wiki the tests use answers the bot's API requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tests"))
+
+import mwparserfromhell
+import pywikibot
+
+from update_vital_article_counts import VitalArticlesBot
+from stub_wiki import StubWiki  # After the bot, which makes the shared base importable
+
+"""
+Benchmark for update_vital_article_counts.py, using a stub wiki with synthetic pages instead of the live wiki
+
+Builds Vital articles list pages of each requested size, with nested sections,
+quota headers and a talk page for every article, some reached through
+redirects. VitalArticlesBot is then run on each page with the stub wiki
+answering its API requests, so the talk pages are fetched in batches as they
+are on the real wiki. The bot's own metrics give the time taken by each phase
+of treat_page, and the peak memory used is measured on a separate run. The
+same is done with -streaming, which fails the benchmark if the page needed the
+full parser after all, or if it wasn't saved with the same text.
+
+The following parameters are supported:
+
+--sizes           Comma separated numbers of articles to list on each page;
+                  100,1000,10000,50000 by default
+
+--repeat          Run the bot this many times and keep the fastest time of
+                  each phase; 3 by default
+
+--seed            Seed for the page generator, so runs can be compared
+
+--output          Write the results to this JSON file as well as printing them
+"""
+
+LIST_PAGE = "Wikipedia:Vital articles/Level/5/Benchmark"
+ASSESSMENTS = ["FA", "FL", "A", "GA", "B", "C", "Start", "Stub", "List"]
+SECTION_NAMES = ["History", "Geography", "Arts", "Philosophy and religion", "Everyday life", "Society and social sciences",
+                 "Biological and health sciences", "Physical sciences", "Technology", "Mathematics"]
+
+
+# Makes a list page with article_count entries split between nested sections, with
+# headers in the formats used on the real pages
+def generate_list_page(rng, article_count):
+    lines = ["{{Vital articles|level=5}}", "{{huge|'''Total articles: 0/50,000'''}}", ""]
+    titles = []
+    remaining = article_count
+    while remaining > 0:
+        level = rng.choice([2, 3, 3, 4])
+        section_size = min(remaining, rng.randint(5, 200))
+        name = "{} {}".format(rng.choice(SECTION_NAMES), len(titles))
+        if rng.random() < 0.3:
+            header = "{0} {1} ({2}/{3} quota) {0}".format("=" * level, name, rng.randint(0, 300), rng.randint(section_size, 500))
+        else:
+            header = "{0} {1} ({2} articles) {0}".format("=" * level, name, rng.randint(0, 300))
+        lines.append(header)
+
+        bullet = "*" if rng.random() < 0.2 else "#"
+        columns = rng.random() < 0.2
+        if columns:
+            lines.append("{{columns-list|colwidth=30em|")
+        for i in range(section_size):
+            title = "Article {}".format(len(titles))
+            titles.append(title)
+            icons = "{{{{Icon|{}}}}}".format(rng.choice(ASSESSMENTS))
+            if rng.random() < 0.02:
+                icons += " {{icon|DGA}}"
+            lines.append("{}{} {} [[{}]]".format(bullet, bullet if rng.random() < 0.1 else "", icons, title))
+        if columns:
+            lines.append("}}")
+        lines.append("")
+        remaining -= section_size
+    return "\n".join(lines), titles
+
+
+# Makes a talk page with a few WikiProject banners, sometimes with article history
+def generate_talk_page(rng):
+    assessment = rng.choice(ASSESSMENTS)
+    banners = ["{{{{WikiProject {}|importance={}}}}}".format(rng.choice(SECTION_NAMES), rng.choice(["Top", "High", "Mid"]))
+               for i in range(rng.randint(1, 4))]
+    text = "{{{{WikiProject banner shell|class={}|\n{}\n}}}}\n".format(assessment, "\n".join(banners))
+    if rng.random() < 0.1:
+        text = "{{{{Article history|action1=GAN|action1result=listed|currentstatus={}}}}}\n".format(rng.choice(["GA", "DGA", "FFA"])) + text
+    return text + "\n== Discussion ==\nSome comments. ~~~~\n"
+
+
+class BenchmarkBot(VitalArticlesBot):
+    """
+    A VitalArticlesBot that saves without showing the diff.
+
+    Showing the diff of a large page takes longer than updating it, and isn't
+    part of what is being measured.
+    """
+
+    def put_current(self, new_text, **kwargs):
+        return super(BenchmarkBot, self).put_current(new_text, show_diff=False, **kwargs)
+
+
+# Fills a stub wiki with the list page, the articles on it and their talk pages.
+# A few articles are redirects, with the talk page at the redirect's target
+def build_wiki(rng, article_count):
+    text, titles = generate_list_page(rng, article_count)
+    wiki = StubWiki()
+    wiki.add_page("User:Bot0612/shutoff/9", "active")
+    wiki.add_page(LIST_PAGE, text)
+    for title in titles:
+        target = title
+        if rng.random() < 0.02:
+            target = "{} (topic)".format(title)
+            wiki.add_page(title, redirect=target)
+        wiki.add_page(target, "An article.")
+        wiki.add_page("Talk:{}".format(target), generate_talk_page(rng))
+    return wiki, text
+
+
+# Runs the bot on the list page, returning its metrics and the text it saved
+def run_bot(wiki, text, streaming):
+    wiki.add_page(LIST_PAGE, text)  # As it was before any earlier run saved it
+    del wiki.edits[:]
+    bot = BenchmarkBot([pywikibot.Page(pywikibot.Site(), LIST_PAGE)], always=True, switchinterval=0, streaming=streaming)
+    bot.metrics.install()
+    bot.run()
+    saved = [title for title, new_text, summary in wiki.edits]
+    if saved != [LIST_PAGE]:
+        raise RuntimeError("The bot was expected to save the list page once, but saved {}".format(saved))
+    return bot.metrics, wiki.pages[LIST_PAGE]["text"]
+
+
+# Runs the bot repeatedly, returning the fastest time of each phase, the API
+# requests made, the peak memory used and the text saved
+def measure(wiki, text, repeat, streaming):
+    best = None
+    for i in range(repeat):
+        metrics, new_text = run_bot(wiki, text, streaming)
+        seconds = {name: phase[0] for name, phase in metrics.phases.items()}
+        best = seconds if best is None else {name: min(best[name], seconds[name]) for name in seconds}
+
+    # Memory is measured on a separate run, as tracing slows everything down
+    tracemalloc.start()
+    run_bot(wiki, text, streaming)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if streaming and metrics.counters["streaming_fallbacks"]:
+        raise RuntimeError("The page needed the full parser, so -streaming wasn't measured")
+    return best, metrics.counters["api_requests"], peak, new_text
+
+
+def run_benchmark(article_count, repeat, seed):
+    rng = random.Random(seed)
+    wiki, text = build_wiki(rng, article_count)
+    wiki.install()
+    try:
+        seconds, api_requests, peak, new_text = measure(wiki, text, repeat, False)
+        streaming_seconds, streaming_api_requests, streaming_peak, streaming_text = measure(wiki, text, repeat, True)
+    finally:
+        wiki.uninstall()
+    if streaming_text != new_text:
+        raise RuntimeError("-streaming saved different text to the full parser")
+
+    return {
+        "articles": article_count,
+        "page_bytes": len(text.encode("utf-8")),
+        "seconds": seconds,
+        "api_requests": api_requests,
+        "peak_memory_bytes": peak,
+        "streaming_seconds": streaming_seconds,
+        "streaming_api_requests": streaming_api_requests,
+        "streaming_peak_memory_bytes": streaming_peak,
+    }
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Benchmark VitalArticlesBot on synthetic pages")
+    parser.add_argument("--sizes", default="100,1000,10000,50000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    options = parser.parse_args(args or None)
+
+    results = {
+        "python": platform.python_version(),
+        "mwparserfromhell": mwparserfromhell.__version__,
+        "seed": options.seed,
+        "results": [],
+    }
+    for size in options.sizes.split(","):
+        result = run_benchmark(int(size), options.repeat, options.seed)
+        results["results"].append(result)
+        print("{:>6} articles: {:.3f}s, peak memory {:.1f} MB; streaming {:.3f}s, peak memory {:.1f} MB".format(
+            result["articles"], result["seconds"]["treat_page"], result["peak_memory_bytes"] / 1e6,
+            result["streaming_seconds"]["treat_page"], result["streaming_peak_memory_bytes"] / 1e6), file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
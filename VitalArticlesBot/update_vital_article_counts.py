@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 from __future__ import absolute_import, unicode_literals
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
+import hashlib
+import io
+import json
 import mwparserfromhell
+import os
+from queue import Queue
 import re
+import sqlite3
+import sys
+import threading
+import time
 
 import pywikibot
-from pywikibot import pagegenerators
+from pywikibot import pagegenerators, xmlreader
 
-from pywikibot.bot import (
-    SingleSiteBot, ExistingPageBot, NoRedirectPageBot, AutomaticTWSummaryBot)
-from pywikibot.tools import issue_deprecation_warning
+# The base shared by every task is kept at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fireflybot import FireflyBot, set_thread_task
 
 """
 Bot script to update the article counts and assessments at [[Wikipedia:Vital articles]]
@@ -27,6 +39,57 @@ The following parameters are supported:
 -top              Place additional text on top of the page
 
 -summary:         Set the action summary message for the edit.
+
+-record:          Record every API request and response to this cassette file
+
+-replay:          Answer API requests from this cassette file instead of the
+                  wiki, as recorded with -record
+
+-metrics:         Write the time spent in each phase of the run, and counts of
+                  API requests, bytes received, retries and cache hits, to
+                  this JSON file
+
+-prometheus:      Write the same totals to this file in the Prometheus text
+                  format
+
+-switchinterval:  Check the task's switch page in the background every this
+                  many seconds, stopping the run once it is turned off; 60 by
+                  default. 0 checks it before every edit instead
+
+-maxrate:         The most API requests to make per second, across all threads
+                  and every task run in the same process. Requests are always
+                  slowed down for a while when the wiki reports lag
+
+-cachefile:       Keep talk page assessments in this SQLite file between runs,
+                  only re-parsing talk pages that have been edited since
+
+-cacheexpiry:     Re-parse cached talk pages after this many days even if they
+                  have not been edited; 30 by default
+
+-workers:         Fetch and assess talk pages on this many threads at once
+
+-dump:            Read the talk pages and redirects from this XML dump file
+                  instead of the API
+
+-source:          Where to look up assessments: talkpage (parse each talk
+                  page, the default), pageassessments (the PageAssessments
+                  API) or dump (the file given with -dump, the default when
+                  -dump is used)
+
+-memosize:        Remember up to this many assessments for articles listed on
+                  more than one page; 100000 by default
+
+-pipeline         Load and parse the next pages while the current one is
+                  being updated, and save pages in the background
+
+-manifest:        Record what each page looked like after this run in this
+                  JSON file, and leave alone the pages and sections whose
+                  text and talk pages haven't changed since the last run
+
+-streaming        Update each page a line at a time, only parsing the lines
+                  with icons on them, to save memory on very large pages.
+                  Pages with markup spanning several lines that could hide
+                  headings or entries are parsed whole as usual
 """
 #
 # (C) Pywikibot team, 2006-2018
@@ -41,72 +104,608 @@ docuReplacements = {
     '&params;': pagegenerators.parameterHelp
 }
 
+# Tags whose contents mwparserfromhell does not parse, so templates inside them don't count
+UNPARSED_TAG_REGEX = re.compile(r"<\s*(?:categorytree|ce|chem|gallery|graph|hiero|imagemap|inputbox|math|nowiki|pre|score|"
+                                r"section|source|syntaxhighlight|templatedata|timeline)\b", re.IGNORECASE)
+SECTION_HEADER_REGEX = re.compile(r"(=+)\s*(.+?)\s*[\(:]\s*?([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)?\s*=+")
+TOTAL_COUNT_REGEX = re.compile(r"([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)")
+NUMBERED_ICON_REGEX = re.compile(r"# \{\{[Ii]con")
+BULLETED_ICON_REGEX = re.compile(r"\* \{\{[Ii]con")
+QUOTA_REGEX = re.compile(r"quota")
+TEMPLATE_TOKEN_REGEX = re.compile(r"<!--.*?-->|\{\{|\}\}|\[\[|\]\]|[{}\[\]|=<]", re.DOTALL)
+LINE_TOKEN_REGEX = re.compile(r"<!--.*?-->|<!--|\{\{|\}\}|\[\[|\]\]|<\s*(/?)\s*([a-zA-Z][\w-]*)[^<>]*?(/?)\s*>|<\s*/?\s*[a-zA-Z]|[|=]")
+TEMPLATE_NAME_REGEX = re.compile(r"\{\{[^{}\[\]<>|\n]*[^\s{}\[\]<>|][^{}\[\]<>|\n]*(?:\||\}\})")
+HEADING_LINE_REGEX = re.compile(r"(={1,6})(?!=)([^\n]*[^=\n])\1[ \t]*$")
+SINGLE_TAGS = {"br", "wbr", "hr", "meta", "link", "img", "li", "dt", "dd", "th", "td", "tr"}  # Tags that need no closing tag
 
-class FireflyBot(
-    SingleSiteBot,  # A bot only working on one site
-    ExistingPageBot,  # CurrentPageBot which only treats existing pages
-    NoRedirectPageBot,  # CurrentPageBot which only treats non-redirects
-):
-    def __init__(self, generator, **kwargs):
+
+def scan_templates(text):
+    """
+    Quickly find the templates in some wikitext, without a full parse.
+
+    Only the template names and named parameters are picked out, which is all
+    that is needed to read assessments from a talk page. Templates are returned
+    in the same order as mwparserfromhell's filter_templates(), nested ones
+    included, each as a (name, params) tuple where name is the raw name text
+    and params maps each stripped parameter name to the raw "name=value" text.
+
+    @param text: the wikitext to scan
+    @type text: unicode
+    @return: the templates, or None if the text has markup that needs the full
+        parser to be read correctly (unbalanced or unusually nested brackets,
+        tags or comments inside templates, unparsed tags, and so on)
+    @rtype: list of tuple or None
+    """
+    if "{{{" in text or UNPARSED_TAG_REGEX.search(text):
+        return None
+
+    found = []
+    stack = []  # Open templates as [start, part_start, equals_pos, parts], open links as their start
+    for match in TEMPLATE_TOKEN_REGEX.finditer(text):
+        token = match.group(0)
+        pos = match.start()
+        template = stack[-1] if stack and isinstance(stack[-1], list) else None
+        in_link = bool(stack) and template is None
+        in_name = template is not None and not template[3]
+
+        if token.startswith("<!--"):
+            if in_link or in_name:
+                return None
+        elif token == "{{":
+            if in_link:
+                return None
+            stack.append([pos, pos + 2, None, []])
+        elif token == "|":
+            if template:
+                template[3].append((template[1], pos, template[2]))
+                template[1] = pos + 1
+                template[2] = None
+        elif token == "=":
+            if in_name:
+                return None
+            if template and template[2] is None:
+                template[2] = pos
+        elif token == "}}":
+            if in_link:
+                return None
+            if template:
+                stack.pop()
+                start, part_start, equals_pos, parts = template
+                parts.append((part_start, pos, equals_pos))
+                name = text[start + 2:parts[0][1]]
+                if not name.strip() or "\n" in name.strip() or ">" in name:
+                    return None
+                if "''" in text[start:pos] or "\n=" in text[start:pos]:  # Possible bold, italics or headings
+                    return None
+                params = {}
+                for part_start, part_end, equals_pos in parts[1:]:
+                    if equals_pos is not None:  # Positional parameters are never needed
+                        params[text[part_start:equals_pos].strip()] = text[part_start:part_end]
+                found.append((start, name, params))
+        elif token == "[[":
+            if in_link or in_name:
+                return None
+            if template:  # Links outside templates can't affect them, so only these are tracked
+                stack.append(pos)
+        elif token == "]]":
+            if in_link:
+                if "\n" in text[stack[-1]:pos]:
+                    return None
+                stack.pop()
+            elif template:
+                return None
+        elif stack:  # Single brackets and tags inside a template
+            return None
+        elif text.startswith("<!--", pos):  # An unclosed comment
+            return None
+
+    if stack:
+        return None
+    found.sort(key=lambda template: template[0])
+    return [(name, params) for start, name, params in found]
+
+
+def scan_lines(text):
+    """
+    Split wikitext into lines, noting which of them can be parsed on their own.
+
+    A line is "top" if it is at the top level of the page, and "nested" if it
+    is inside a template that spans several lines but holds nothing that could
+    be read as part of that template, such as a list entry in {{columns-list}}.
+    Either way, mwparserfromhell reads the line on its own the same way as it
+    does as part of the page. Any other line is "other". Lines are read one at
+    a time, so the page is never parsed as a whole.
+
+    @param text: the wikitext to scan
+    @type text: unicode
+    @return: the offset, text and kind of each line, without its newline. The
+        kind is None, and the scan stops, if the text has markup that needs the
+        full parser to be read correctly (tags or comments over several lines,
+        tables, unusual template names, stray brackets and so on)
+    @rtype: generator of tuple
+    """
+    if "{{{" in text or "}}}" in text or UNPARSED_TAG_REGEX.search(text):
+        yield 0, text, None
+        return
+
+    depth = 0  # Templates open at the start of the line
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        line = text[start:] if end == -1 else text[start:end]
+        if line.lstrip().startswith("{|"):  # Tables are parsed as tags over several lines
+            yield start, line, None
+            return
+
+        line_depth = depth
+        lowest = depth
+        links = 0
+        tags = []
+        separated = False  # A bar or equals sign outside any markup opened on the line
+        for match in LINE_TOKEN_REGEX.finditer(line):
+            token = match.group(0)
+            if token.startswith("<!--"):
+                if not token.endswith("-->"):
+                    yield start, line, None
+                    return
+            elif token == "{{":
+                if not TEMPLATE_NAME_REGEX.match(line, match.start()):
+                    yield start, line, None
+                    return
+                depth += 1
+            elif token == "}}":
+                depth -= 1
+                lowest = min(lowest, depth)
+                if depth < 0:
+                    yield start, line, None
+                    return
+            elif token == "[[":
+                links += 1
+            elif token == "]]":
+                links -= 1
+                if links < 0:
+                    yield start, line, None
+                    return
+            elif token.startswith("<"):
+                closing, name, self_closing = match.groups()
+                if name is None:  # Not a complete tag
+                    yield start, line, None
+                    return
+                if depth == line_depth and links == 0 and ("|" in token or "=" in token):
+                    separated = True
+                if name.lower() in SINGLE_TAGS or self_closing:
+                    continue
+                if not closing:
+                    tags.append(name.lower())
+                elif not tags or tags.pop() != name.lower():
+                    yield start, line, None
+                    return
+            elif depth == line_depth and links == 0:
+                separated = True
+        if links or tags:
+            yield start, line, None
+            return
+
+        if depth != line_depth or lowest < line_depth:
+            kind = "other"
+        elif depth == 0:
+            kind = "top"
+        else:
+            kind = "other" if separated else "nested"
+        yield start, line, kind
+        if end == -1:
+            break
+        start = end + 1
+    if depth:
+        yield len(text), "", None
+
+
+class AssessmentCache(object):
+    """
+    An on-disk cache of talk page assessments.
+
+    Each talk page's (assessment, is_dga, is_ffa) result is stored against the
+    revision it was computed from, so it stays valid until the page is edited.
+    Entries older than the expiry are dropped when the cache is opened. The
+    cache can be used from any thread, e.g. when the bot is started by
+    run_tasks() on a thread of its own.
+    """
+
+    def __init__(self, filename, expiry_days=30):
         """
         Constructor.
 
-        @param generator: the page generator that determines on which pages
-            to work
-        @type generator: generator
+        @param filename: path of the SQLite database file
+        @type filename: unicode
+        @param expiry_days: age in days after which entries are discarded
+        @type expiry_days: float
         """
-        # Add your own options to the bot and set their defaults
-        # -always option is predefined by BaseBot class
-        self.availableOptions.update({
-            'replace': False,  # delete old text and write the new text
-            'summary': None,  # your own bot summary
-            'text': 'Test',  # add this text from option. 'Test' is default
-            'top': False,  # append text on top of the page
-        })
-        
-        self.task_number = -1
-        self.check_page = "User:Bot0612/shutoff/{}"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS assessments ("
+                                "title TEXT PRIMARY KEY, revid INTEGER, assessment TEXT, "
+                                "is_dga INTEGER, is_ffa INTEGER, cached REAL)")
+        self.connection.execute("DELETE FROM assessments WHERE cached < ?",
+                                (time.time() - expiry_days * 86400,))
+        self.connection.commit()
 
-        # call constructor of the super class
-        super(FireflyBot, self).__init__(site=True, **kwargs)
+    def get(self, title, revid):
+        with self.lock:
+            row = self.connection.execute("SELECT assessment, is_dga, is_ffa FROM assessments "
+                                          "WHERE title = ? AND revid = ?", (title, revid)).fetchone()
+        if row is None:
+            return None
+        return row[0], bool(row[1]), bool(row[2])
 
-        # handle old -dry parameter
-        self._handle_dry_param(**kwargs)
+    def put(self, title, revid, quality):
+        assessment, is_dga, is_ffa = quality
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO assessments VALUES (?, ?, ?, ?, ?, ?)",
+                                    (title, revid, assessment, is_dga, is_ffa, time.time()))
 
-        # assign the generator to the bot
-        self.generator = generator
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
 
-    def check_task_switch_is_on(self):
-        check_page = pywikibot.Page(self.site, self.check_page.format(self.task_number))
-        return (check_page.text.strip() == "active")
-        
-    def _handle_dry_param(self, **kwargs):
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class RunManifest(object):
+    """
+    A record of what each page looked like when the bot last left it.
+
+    For each page it keeps a hash of the text the bot left, and for each
+    section a hash of its text and the talk page revisions its assessments
+    came from. Sections whose text and talk pages haven't changed since can
+    be left alone on the next run.
+    """
+
+    def __init__(self, filename):
         """
-        Read the dry parameter and set the simulate variable instead.
+        Constructor.
 
-        This is a private method. It prints a deprecation warning for old
-        -dry paramter and sets the global simulate variable and informs
-        the user about this setting.
+        @param filename: path of the JSON manifest file
+        @type filename: unicode
+        """
+        self.filename = filename
+        self.pages = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.pages = json.load(f)
 
-        The constuctor of the super class ignores it because it is not
-        part of self.availableOptions.
+    def get(self, title):
+        return self.pages.get(title)
 
-        @note: You should ommit this method in your own application.
+    def put(self, title, text_hash, sections, assessed):
+        self.pages[title] = {"text_hash": text_hash, "sections": sections, "assessed": assessed}
 
-        @keyword dry: deprecated option to prevent changes on live wiki.
-            Use -simulate instead.
-        @type dry: bool
+    def save(self):
+        # Write to a temporary file first so an interrupted save can't lose the old manifest
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(self.pages, f, sort_keys=True)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+class AssessmentMemo(object):
+    """
+    A size-bounded, least recently used store of assessments for one run.
+
+    Articles listed on several of the pages being updated are only looked up
+    the first time; later lookups count as hits.
+    """
+
+    def __init__(self, max_size):
         """
-        if 'dry' in kwargs:
-            issue_deprecation_warning('dry argument',
-                                      'pywikibot.config.simulate', 1)
-            # use simulate variable instead
-            pywikibot.config.simulate = True
-            pywikibot.output('config.simulate was set to True')
+        Constructor.
 
-    def treat_page(self):
+        @param max_size: most assessments to keep before dropping the least
+            recently used
+        @type max_size: int
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, title):
+        quality = self.entries.get(title)
+        if quality is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(title)
+        return quality
+
+    def put(self, title, quality):
+        self.entries[title] = quality
+        self.entries.move_to_end(title)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class AssessmentSource(object):
+    """
+    Somewhere to look up the assessments of Vital articles.
+
+    Subclasses implement get_assessments(), which looks up many articles at
+    once and returns an (assessment, is_dga, is_ffa) tuple for each, with
+    assessment being one of VitalArticlesBot.assessment_order.
+    """
+
+    def __init__(self, bot):
+        """
+        Constructor.
+
+        @param bot: the bot the assessments are being looked up for
+        @type bot: VitalArticlesBot
+        """
+        self.bot = bot
+        self.site = bot.site
+
+    # Called with the bot's pages before any of them are treated. Returns the
+    # pages to treat, so a source can read through them first if it needs to
+    def prepare(self, pages):
+        return pages
+
+    def get_assessments(self, titles):
+        """
+        Look up the assessments of many articles.
+
+        @param titles: the article titles to look up
+        @type titles: iterable of unicode
+        @return: (assessment, is_dga, is_ffa) for each title
+        @rtype: dict
+        """
+        raise NotImplementedError
+
+    def close(self):
         pass
 
+    # Follows redirects for many article titles at once. Returns a dict mapping
+    # each title to the title whose talk page holds its assessment
+    def resolve_redirects(self, titles):
+        normalised = {title: pywikibot.Page(self.site, title).title() for title in titles}
+        api_normalised = {}
+        redirects = {}
+        for query in self.bot.query_titles(set(normalised.values()), redirects=True):
+            api_normalised.update((item["from"], item["to"]) for item in query.get("normalized", []))
+            redirects.update((item["from"], item["to"]) for item in query.get("redirects", []))
+        return self.follow_titles(normalised, api_normalised, redirects)
+
+    # Gets the current revision ID of many pages at once. Pages that do not
+    # exist get a revision ID of 0
+    def get_latest_revision_ids(self, titles):
+        normalised = {}
+        revision_ids = {}
+        for query in self.bot.query_titles(titles, prop="info"):
+            normalised.update((item["from"], item["to"]) for item in query.get("normalized", []))
+            for page in query.get("pages", {}).values():
+                revision_ids[page["title"]] = page.get("lastrevid", 0)
+        return {title: revision_ids.get(normalised.get(title, title), 0) for title in titles}
+
+    # Gets the revision ID of the talk page each article's assessment comes from,
+    # following redirects. A changed ID means the article may need reassessing
+    def get_dependencies(self, titles):
+        resolved = self.resolve_redirects(titles)
+        talk_titles = {title: "Talk:{}".format(target) for title, target in resolved.items()}
+        revision_ids = self.get_latest_revision_ids(list(set(talk_titles.values())))
+        return {title: revision_ids[talk_title] for title, talk_title in talk_titles.items()}
+
+    # Follows normalisations and then one redirect from the API's "normalized"
+    # and "redirects" maps. Pesky redirects
+    @staticmethod
+    def follow_titles(titles, normalised, redirects):
+        resolved = {}
+        for title, page_title in titles.items():
+            page_title = normalised.get(page_title, page_title)
+            resolved[title] = redirects.get(page_title, page_title)
+        return resolved
+
+
+class TalkPageAssessmentSource(AssessmentSource):
+    """
+    Assesses articles by downloading and parsing their talk pages.
+
+    Results can be kept in an AssessmentCache between runs, and the talk pages
+    fetched on several threads at once.
+    """
+
+    def __init__(self, bot, cache=None, workers=1):
+        """
+        Constructor.
+
+        @param bot: the bot the assessments are being looked up for
+        @type bot: VitalArticlesBot
+        @param cache: cache of earlier assessments, if any
+        @type cache: AssessmentCache
+        @param workers: number of threads to fetch talk pages on
+        @type workers: int
+        """
+        super(TalkPageAssessmentSource, self).__init__(bot)
+        self.cache = cache
+        self.workers = workers
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    # Resolves redirects and loads the talk pages in batches rather than one
+    # request per article
+    def get_assessments(self, titles):
+        resolved = self.resolve_redirects(titles)
+
+        talk_pages = {}
+        for target in set(resolved.values()):
+            talk_pages[target] = pywikibot.Page(self.site, "Talk:{}".format(target))
+
+        # With a cache, only talk pages edited since they were last assessed need downloading
+        qualities = {}
+        if self.cache is not None:
+            revision_ids = self.get_latest_revision_ids([talk_page.title() for talk_page in talk_pages.values()])
+            for target, talk_page in talk_pages.items():
+                quality = self.cache.get(talk_page.title(), revision_ids[talk_page.title()])
+                if quality is not None:
+                    qualities[target] = quality
+            self.bot.metrics.count("assessment_cache_hits", len(qualities))
+            if self.bot.verbose:
+                pywikibot.output("{} of {} assessments found in the cache".format(len(qualities), len(talk_pages)))
+
+        to_load = [(target, talk_page) for target, talk_page in talk_pages.items() if target not in qualities]
+        batch_size = self.bot.title_batch_size
+        if self.workers > 1:
+            batches = [to_load[i:i + batch_size] for i in range(0, len(to_load), batch_size)]
+            with ThreadPoolExecutor(max_workers=self.workers, initializer=set_thread_task, initargs=(self.bot,)) as pool:
+                for batch_qualities in pool.map(self.assess_talk_page_batch, batches):
+                    qualities.update(batch_qualities)
+        else:
+            qualities.update(self.assess_talk_page_batch(to_load))
+
+        if self.cache is not None:
+            for target, talk_page in to_load:
+                self.cache.put(talk_page.title(), revision_ids[talk_page.title()], qualities[target])
+            self.cache.commit()
+        return {title: qualities[target] for title, target in resolved.items()}
+
+    # Downloads a batch of talk pages and assesses them. With -workers this runs
+    # on several threads at once, sharing the bot's request scheduler
+    def assess_talk_page_batch(self, batch):
+        with self.bot.metrics.phase("talk_fetch"):
+            for talk_page in self.site.preloadpages([talk_page for target, talk_page in batch], groupsize=self.bot.title_batch_size):
+                pass  # Loads the page text into the objects in the batch
+        with self.bot.metrics.phase("talk_parse"):
+            return {target: self.bot.assess_talk_page_text(talk_page.text) for target, talk_page in batch}
+
+
+class PageAssessmentsSource(AssessmentSource):
+    """
+    Looks up assessments with the PageAssessments extension's API.
+
+    Classes come from prop=pageassessments, which needs no talk page text at
+    all. The extension does not know about delisted or former featured
+    articles, so those come from the talk pages' categories instead.
+    """
+
+    batch_size = 50  # PageAssessments returns at most 50 titles' projects per request for most users
+    class_names = {"b+": "bplus", "disambig": "dab"}
+    dga_category = "Category:Delisted good articles"
+    ffa_category = "Category:Wikipedia former featured articles"
+
+    # Picks the highest class given by any WikiProject, the same way assess_talk_page_text does
+    def assess_projects(self, projects):
+        assessments = []
+        for project in projects.values():
+            assessment = project.get("class", "").lower()
+            assessment = self.class_names.get(assessment, assessment)
+            if assessment in self.bot.assessment_order:
+                assessments.append(assessment)
+        assessments.sort(key=self.bot.assessment_order.index)
+        return assessments[0] if assessments else "unassessed"
+
+    def get_assessments(self, titles):
+        titles = {title: pywikibot.Page(self.site, title).title() for title in titles}
+        normalised = {}
+        redirects = {}
+        projects = {}
+        for query in self.bot.query_titles(set(titles.values()), batch_size=self.batch_size,
+                                           prop="pageassessments", palimit="max", redirects=True):
+            normalised.update((item["from"], item["to"]) for item in query.get("normalized", []))
+            redirects.update((item["from"], item["to"]) for item in query.get("redirects", []))
+            for page in query.get("pages", {}).values():
+                # Continued requests add more projects to pages already seen
+                projects.setdefault(page["title"], {}).update(page.get("pageassessments", {}))
+        resolved = self.follow_titles(titles, normalised, redirects)
+
+        qualities = {}
+        for target in set(resolved.values()):
+            qualities[target] = self.assess_projects(projects.get(target, {}))
+
+        # Only articles that have been assessed can have been delisted
+        talk_titles = {target: "Talk:{}".format(target) for target, assessment in qualities.items()
+                       if assessment not in ("dab", "unassessed")}
+        categories = {}
+        for query in self.bot.query_titles(set(talk_titles.values()), prop="categories", cllimit="max",
+                                           clcategories=[self.dga_category, self.ffa_category]):
+            for page in query.get("pages", {}).values():
+                categories.setdefault(page["title"], set()).update(
+                    category["title"] for category in page.get("categories", []))
+
+        for target, assessment in qualities.items():
+            talk_categories = categories.get(talk_titles.get(target), set())
+            qualities[target] = (assessment, self.dga_category in talk_categories, self.ffa_category in talk_categories)
+        return {title: qualities[target] for title, target in resolved.items()}
+
+
+class DumpAssessmentSource(AssessmentSource):
+    """
+    Assesses articles from the talk pages in an XML dump, with no API reads.
+
+    The bot's pages are read before any are treated so that every article
+    can be looked up in a single pass over the dump.
+    """
+
+    def __init__(self, bot, filename):
+        """
+        Constructor.
+
+        @param bot: the bot the assessments are being looked up for
+        @type bot: VitalArticlesBot
+        @param filename: path of the XML dump, which may be compressed
+        @type filename: unicode
+        """
+        super(DumpAssessmentSource, self).__init__(bot)
+        self.filename = filename
+        self.qualities = {}
+
+    def prepare(self, pages):
+        pages = list(pages)
+        titles = set()
+        for page in pages:
+            titles.update(title for line, title in self.bot.get_entries(mwparserfromhell.parse(page.text, skip_style_tags=True)))
+        self.qualities = self.read_dump_qualities(titles)
+        return pages
+
+    def get_assessments(self, titles):
+        return {title: self.qualities[pywikibot.Page(self.site, title).title()] for title in titles}
+
+    # Gets the assessments of many articles from the dump, following redirects
+    # in the dump too. Returns a dict keyed by normalised article title. Only the
+    # results are kept while the dump is streamed, not the page text
+    def read_dump_qualities(self, titles):
+        article_titles = set(pywikibot.Page(self.site, title).title() for title in titles)
+        redirect_regex = self.site.redirect_regex
+        redirects = {}
+        talk_qualities = {}
+
+        def read_dump(talk_titles, article_titles):
+            for entry in xmlreader.XmlDump(self.filename).parse():
+                if entry.ns == "0" and entry.isredirect and entry.title in article_titles:
+                    match = redirect_regex.match(entry.text)
+                    if match:
+                        redirects[entry.title] = pywikibot.Page(self.site, match.group(1)).title()
+                elif entry.ns == "1" and entry.title in talk_titles:
+                    talk_qualities[entry.title] = self.bot.assess_talk_page_text(entry.text)
+
+        pywikibot.output("Reading assessments for {} articles from {}".format(len(article_titles), self.filename))
+        read_dump(set("Talk:{}".format(title) for title in article_titles), article_titles)
+
+        # A redirect target's talk page may have come before the redirect in the dump
+        missed = set("Talk:{}".format(target) for target in redirects.values()) - set(talk_qualities)
+        if missed:
+            pywikibot.output("Reading the dump again for {} redirect targets".format(len(missed)))
+            read_dump(missed, set())
+
+        qualities = {}
+        for title in article_titles:
+            talk_title = "Talk:{}".format(redirects.get(title, title))  # Pesky redirects
+            if talk_title not in talk_qualities:  # No talk page in the dump
+                talk_qualities[talk_title] = self.bot.assess_talk_page_text("")
+            qualities[title] = talk_qualities[talk_title]
+        return qualities
+
+
 class VitalArticlesBot(FireflyBot):
 
     assessment_order = ["fa", "fl", "a", "ga", "bplus", "b", "c", "start", "stub", "dab", "list", "unassessed"]
@@ -115,11 +714,22 @@ class VitalArticlesBot(FireflyBot):
     article_history_templates = ["article history", "articlehistory", "articlemilestones", "ah"]
     skip_assessment = False
     verbose = False
+    pipeline_depth = 2  # pages prepared ahead of the one being updated
+    stream_batch_size = 1000  # articles looked up together when streaming a page
 
     def __init__(self, generator, **kwargs):
         self.availableOptions.update({
                 'skipassessment': False,
-                'verbose': False
+                'verbose': False,
+                'cachefile': None,  # SQLite file to keep assessments in between runs
+                'cacheexpiry': 30,  # days before a cached assessment is recomputed
+                'workers': 1,  # threads used to fetch and assess talk pages
+                'dump': None,  # XML dump to read talk pages and redirects from
+                'source': None,  # where assessments come from: talkpage, pageassessments or dump
+                'memosize': 100000,  # assessments remembered between pages in one run
+                'pipeline': False,  # prepare the next page and save in the background
+                'manifest': None,  # JSON file recording what each page looked like after the last run
+                'streaming': False,  # update pages a line at a time instead of parsing them whole
         })
 
         # call constructor of the super class
@@ -127,52 +737,118 @@ class VitalArticlesBot(FireflyBot):
         self.task_number = 9
         self.skip_assessment = self.options.get("skipassessment")
         self.verbose = self.options.get("verbose")
+
+        source = self.getOption("source") or ("dump" if self.getOption("dump") else "talkpage")
+        if source == "talkpage":
+            cache = None
+            if self.getOption("cachefile"):
+                cache = AssessmentCache(self.getOption("cachefile"), float(self.getOption("cacheexpiry")))
+            self.source = TalkPageAssessmentSource(self, cache, int(self.getOption("workers")))
+        elif source == "pageassessments":
+            self.source = PageAssessmentsSource(self)
+        elif source == "dump":
+            if not self.getOption("dump"):
+                raise ValueError("-source:dump needs a dump file given with -dump")
+            self.source = DumpAssessmentSource(self, self.getOption("dump"))
+        else:
+            raise ValueError("Unknown assessment source {}".format(source))
+
+        self.memo = AssessmentMemo(int(self.getOption("memosize")))
+        self.pipeline = self.getOption("pipeline")
+        self.prepared_page = None
+
+        self.streaming = self.getOption("streaming")
+
+        self.manifest = None
+        if self.getOption("manifest"):
+            if isinstance(self.source, DumpAssessmentSource):
+                raise ValueError("-manifest can't be used with -source:dump")
+            if self.streaming:
+                raise ValueError("-manifest can't be used with -streaming")
+            self.manifest = RunManifest(self.getOption("manifest"))
+
+    @property
+    def request_threads(self):
+        workers = self.source.workers if isinstance(self.source, TalkPageAssessmentSource) else 1
+        return max(workers, 1) + (1 if self.pipeline else 0)  # The page prefetch thread loads pages too
+
+    def run(self):
+        if not self.skip_assessment:
+            self.generator = self.source.prepare(self.generator)
+        if self.pipeline:
+            self.generator = self.prefetch_pages(self.generator)
+        super(VitalArticlesBot, self).run()
+
+    # Loads and parses pages on a background thread, a few pages ahead of the one
+    # being updated. The parse tree of each page is left in prepared_page for
+    # treat_page as the page is yielded
+    def prefetch_pages(self, pages):
+        queue = Queue(maxsize=self.pipeline_depth)
+        finished = object()
+
+        def prepare():
+            try:
+                for page in pages:
+                    # Streamed pages are only parsed if they turn out to need it
+                    queue.put((page, None if self.streaming else mwparserfromhell.parse(page.text, skip_style_tags=True)))
+            except Exception as e:  # Raised again on the bot's thread
+                queue.put(e)
+            queue.put(finished)
+
+        self.start_thread(prepare, "VitalArticlesBot page prefetch")
+        while True:
+            item = queue.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            self.prepared_page = item
+            yield item[0]
+
+    def teardown(self):
+        if not self.skip_assessment:
+            pywikibot.output("Assessment lookups: {} remembered from earlier pages, {} looked up".format(self.memo.hits, self.memo.misses))
+        self.source.close()
+        if self.manifest is not None:
+            self.manifest.save()
+        super(VitalArticlesBot, self).teardown()
     
-    # Gets the article's assessment. If the page has multiple different assessments
-    # then the HIGHEST assessment is used
-    def get_vital_article_quality(self, page_title):
+    # Gets the article's assessment from its talk page text. If the page has multiple
+    # different assessments then the HIGHEST assessment is used
+    def assess_talk_page_text(self, text):
 
         def sanitise_assessment(ass):  # Hehehe 'ass'. I'm a serious programmer.
             ass = ass.lower()
             return ass.split("<!")[0].strip()  # Gets rid of <!-- HTML comments -->
 
+        templates = scan_templates(text)
+        if templates is None:  # Leave anything unusual to the full parser
+            templates = [(str(template.name), {str(param.name).strip(): str(param) for param in template.params})
+                         for template in mwparserfromhell.parse(text).filter_templates()]
+
         assessments = []
-        article_page = pywikibot.Page(self.site, page_title)
-        
-         # Pesky redirects
-        if article_page.isRedirectPage():
-            talk_page = pywikibot.Page(self.site, "Talk:{}".format(article_page.getRedirectTarget().title()))
-        else:
-            talk_page = pywikibot.Page(self.site, "Talk:{}".format(page_title))
-        
-        talk_wikicode = mwparserfromhell.parse(talk_page.text)
-        
         is_dga = False
         is_ffa = False
         
-        for template in talk_wikicode.filter_templates():
-            template_name_lower = template.name.lower()
+        for name, params in templates:
+            template_name_lower = name.lower()
             
             if template_name_lower in self.dga_templates:
                 is_dga = True
             elif template_name_lower in self.article_history_templates:
-                try:
-                    cur_status = template.get("currentstatus").split("=")[1].strip()
+                if "currentstatus" in params:
+                    cur_status = params["currentstatus"].split("=")[1].strip()
                     is_dga = cur_status.lower() == "dga"
                     is_ffa = cur_status.lower() == "ffa"
-                except ValueError:
-                    pass
                 continue
             
-            try:
-                assessment = sanitise_assessment(template.get("class").split("=")[1])
+            if "class" in params:  # The WikiProject template may not have an assessment parameter
+                assessment = sanitise_assessment(params["class"].split("=")[1])
                 if assessment in self.assessment_order:  # Reject invalid assessment classes (e.g. if someone has vandalised the template)
                     assessments.append(assessment)
-            except ValueError:  # The WikiProject template may not have an assessment parameter
-                continue  # Skip to the next one
 
         if len(assessments) == 0:
-            if "WikiProject Disambiguation" in talk_page.text:
+            if "WikiProject Disambiguation" in text:
                 return "dab", False, False
             else:
                 return "unassessed", False, False
@@ -180,6 +856,30 @@ class VitalArticlesBot(FireflyBot):
             assessments.sort(key=lambda x: self.assessment_order.index(x) if x in self.assessment_order else 255)
         return assessments[0], is_dga, is_ffa
 
+    # Gets a single article's assessment. Use get_vital_article_qualities when
+    # there is more than one article to look up
+    def get_vital_article_quality(self, page_title):
+        return self.get_vital_article_qualities([page_title])[page_title]
+
+    # Gets the assessments of many articles at once from the chosen source. Articles
+    # already looked up for an earlier page in this run are not looked up again
+    def get_vital_article_qualities(self, page_titles):
+        normalised = {title: pywikibot.Page(self.site, title).title() for title in page_titles}
+        qualities = {}
+        for title in set(normalised.values()):
+            quality = self.memo.get(title)
+            if quality is not None:
+                qualities[title] = quality
+
+        missing = set(normalised.values()) - set(qualities)
+        self.metrics.count("memo_hits", len(qualities))
+        self.metrics.count("memo_misses", len(missing))
+        if missing:
+            for title, quality in self.source.get_assessments(missing).items():
+                self.memo.put(title, quality)
+                qualities[title] = quality
+        return {title: qualities[page_title] for title, page_title in normalised.items()}
+
     # The relevant article will be the first link in a line
     @staticmethod
     def get_article_link(line):
@@ -192,50 +892,93 @@ class VitalArticlesBot(FireflyBot):
                     return bare_name
         return None
 
-    def treat_page(self):
-        # Grab the page text and parse it
-        text = self.current_page.text
-        wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
+    @staticmethod
+    def format_section_header(old_header_match, article_count, has_quota):
+        old_header = old_header_match.group(0)
+        old_header_groups = old_header_match.groups()
+        use_colon = "current total" in old_header.lower() and ":" in old_header
+        new_header = "{0}{1} {6}{2}{4} article{3}{5}{7}{0}".format(old_header_groups[0],
+                                                            old_header_groups[1],
+                                                            article_count,
+                                                            "" if article_count == 1 or has_quota else "s",
+                                                            old_header_groups[3] if len(old_header_groups) > 3 and old_header_groups[3] is not None else "",
+                                                            " quota" if has_quota else "",
+                                                            ":" if use_colon else "(",
+                                                            "" if use_colon else ")")
+
+        return new_header.replace("article quota", "quota")
+
+    # Counts the articles in each section, updates the section headers accordingly
+    # and then updates the 'total articles' count. The page is walked once to find
+    # where each section starts and ends; everything else is looked up from that
+    def update_section_counts(self, wikicode):
+        text = str(wikicode)
+
+        # Top-level headings, with the text offsets at which their sections start and end
+        headings = []  # [index, heading, start, end]
+        open_headings = []
+        offset = 0
+        for index, node in enumerate(wikicode.nodes):
+            if isinstance(node, mwparserfromhell.nodes.Heading):
+                while open_headings and open_headings[-1][1].level >= node.level:
+                    open_headings.pop()[3] = offset
+                heading = [index, node, offset, len(text)]
+                headings.append(heading)
+                open_headings.append(heading)
+            offset += len(str(node))
+
+        def count_between(positions, start, end):
+            return bisect_left(positions, end) - bisect_left(positions, start)
+
+        numbered = [match.start() for match in NUMBERED_ICON_REGEX.finditer(text)]
+        bulleted = [match.start() for match in BULLETED_ICON_REGEX.finditer(text)]
+        quotas = [match.start() for match in QUOTA_REGEX.finditer(text)]
 
-        # Count the articles in each section and update the header accordingly
-        for section in wikicode.get_sections(include_lead=False):
-            article_count = section.count("# {{Icon") + section.count("# {{icon")
+        # Work out every section's new header from the original text
+        replacements = []
+        for index, heading, start, end in headings:
+            article_count = count_between(numbered, start, end)
             if article_count == 0:
-                article_count = section.count("* {{Icon") + section.count("* {{icon")
-            old_header_match = re.match(r"(=+)\s*(.+?)\s*[\(:]\s*?([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)?\s*=+", str(section))
+                article_count = count_between(bulleted, start, end)
+            old_header_match = SECTION_HEADER_REGEX.match(text, start, end)
             if old_header_match is None:
                 continue
-            old_header = old_header_match.group(0)
-            has_quota = "quota" in str(section)
-            old_header_groups = old_header_match.groups()
-            use_colon = "current total" in old_header.lower() and ":" in old_header
-            new_header = "{0}{1} {6}{2}{4} article{3}{5}{7}{0}".format(old_header_groups[0],
-                                                                old_header_groups[1],
-                                                                article_count,
-                                                                "" if article_count == 1 or has_quota else "s",
-                                                                old_header_groups[3] if len(old_header_groups) > 3 and old_header_groups[3] is not None else "",
-                                                                " quota" if has_quota else "",
-                                                                ":" if use_colon else "(",
-                                                                "" if use_colon else ")")
-
-            new_header = new_header.replace("article quota", "quota")
+            has_quota = count_between(quotas, start, end - len("quota") + 1) > 0
+            new_header = self.format_section_header(old_header_match, article_count, has_quota)
             if old_header_match.group(0).replace(",","") != new_header:
+                replacements.append((index, heading, end, old_header_match, new_header))
+
+        # Then update them, keeping track of how far each replacement moves the later nodes
+        shift = 0
+        for index, heading, end, old_header_match, new_header in replacements:
+            if old_header_match.group(0) == str(heading):
+                new_nodes = mwparserfromhell.parse(new_header).nodes
+                wikicode.nodes[index + shift:index + shift + 1] = new_nodes
+                shift += len(new_nodes) - 1
+            else:  # The header match doesn't line up with the heading node, so use a text replace
+                section_end = next((i for i, h, s, e in headings if s >= end), len(wikicode.nodes) - shift)
+                section = mwparserfromhell.wikicode.Wikicode(wikicode.nodes[index + shift:section_end + shift])
                 section.replace(old_header_match.group(0), new_header)
+                shift += len(section.nodes) - (section_end - index)
 
-        # Add all the top-level headings together for the 'total articles' count
+    # Adds all the top-level headings' counts together for the 'total articles' count
+    def update_total_count(self, wikicode):
+        top_level_headings = [node for node in wikicode.nodes if isinstance(node, mwparserfromhell.nodes.Heading)]
         total_count = 0
-        for i in range(1,10):
-            top_level_sections = wikicode.get_sections(levels=[i])
-            if len(top_level_sections) > 0:
-                for section in top_level_sections:
-                    heading = str(section.filter_headings()[0])
-                    heading_match = re.search(r"([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)", heading)
-                    if heading_match is None:
-                        continue
-                    total_count += int(heading_match.group(1).replace(",",""))
-                break
+        if top_level_headings:
+            top_level = min(heading.level for heading in top_level_headings)
+            for heading in top_level_headings:
+                if heading.level != top_level:
+                    continue
+                heading_match = TOTAL_COUNT_REGEX.search(str(heading))
+                if heading_match is None:
+                    continue
+                total_count += int(heading_match.group(1).replace(",",""))
+        self.update_huge_templates(wikicode, total_count)
 
-        # Update the 'total articles' count
+    # Updates the 'total articles' count in the page's {{huge}} templates
+    @staticmethod
+    def update_huge_templates(wikicode, total_count):
         for template in wikicode.filter_templates():
             if template.name.matches("huge"):
                 denominator = ""
@@ -244,64 +987,356 @@ class VitalArticlesBot(FireflyBot):
                     denominator = "/{}".format(param.split("/")[-1].strip("'"))
                 template.add("1", "Total articles: {}{}".format(total_count, denominator))
 
-        if not self.skip_assessment:
-            # Split article into individual lines
-            line_list = [list(group) for k, group in groupby(wikicode.filter(), lambda x: "\n" in x) if not k]
-
-            # Process each line, looking for article links, then check their assessment
-            for line in line_list:
-                if line[0] == "#" or line[0] == "*":
-                    article_title = self.get_article_link(line)
-                    if article_title is None or "Wikipedia:" in article_title or "Category:" in article_title or "User:" in article_title or "Template:" in article_title or "Portal:" in article_title:
+    # Splits the page into lines, each a list of nodes. This gives the same lines
+    # as grouping wikicode.filter() on nodes containing newlines, but only checks
+    # the top-level nodes unless one of them spans several lines itself
+    @staticmethod
+    def get_lines(wikicode):
+        def nodes_and_breaks():
+            for node in wikicode.nodes:
+                descendants = mwparserfromhell.wikicode.Wikicode([node]).ifilter()
+                next(descendants)  # The node itself
+                if "\n" in node:
+                    yield node, True
+                    for descendant in descendants:
+                        yield descendant, "\n" in descendant
+                else:
+                    yield node, False
+                    for descendant in descendants:
+                        yield descendant, False
+
+        return [[node for node, is_break in group] for is_break, group in groupby(nodes_and_breaks(), lambda x: x[1]) if not is_break]
+
+    # Finds the list lines on the page, with the article each one links to
+    def get_entries(self, wikicode):
+        entries = []
+        for line in self.get_lines(wikicode):
+            if line[0] == "#" or line[0] == "*":
+                article_title = self.get_article_link(line)
+                if article_title is None or "Wikipedia:" in article_title or "Category:" in article_title or "User:" in article_title or "Template:" in article_title or "Portal:" in article_title:
+                    continue
+                entries.append((line, article_title))
+        return entries
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    # Splits the page into sections at its top-level headings. Returns the hash of
+    # each section's text below its heading, with the entries listed in that section
+    def get_sections(self, wikicode, entries):
+        sections = [[]]
+        for node in wikicode.nodes:
+            if isinstance(node, mwparserfromhell.nodes.Heading):
+                sections.append([])
+            else:
+                sections[-1].append(node)
+
+        section_of = {}
+        for index, nodes in enumerate(sections):
+            for node in nodes:
+                for descendant in mwparserfromhell.wikicode.Wikicode([node]).ifilter():
+                    section_of[id(descendant)] = index
+        section_entries = [[] for nodes in sections]
+        for line, article_title in entries:
+            section_entries[section_of.get(id(line[0]), 0)].append((line, article_title))
+        return [(self.hash_text("".join(str(node) for node in nodes)), section_entries[index]) for index, nodes in enumerate(sections)]
+
+    # Checks the assessment of the article on each line and updates its icons to match.
+    # Only the given entries are checked if there are any
+    def update_assessments(self, wikicode, entries=None):
+        # Find the article linked from each line so that all of their assessments
+        # can be fetched together
+        if entries is None:
+            entries = self.get_entries(wikicode)
+        qualities = self.get_vital_article_qualities(set(title for line, title in entries))
+
+        # Icons to remove and add are collected by node ID, and applied to the page
+        # together once every line has been checked
+        removals = set()
+        insertions = {}
+
+        # Process each line, checking the assessment of its article
+        for line, article_title in entries:
+            self.update_entry_icons(line, qualities[article_title], removals, insertions)
+
+        self.apply_icon_edits(wikicode, removals, insertions)
+
+    # Checks the icons on one line against its article's assessment, adding the icons
+    # to remove and add to removals and insertions for apply_icon_edits
+    def update_entry_icons(self, line, quality, removals, insertions):
+        article_assessment, is_dga, is_ffa = quality
+
+        count = 0
+        dga_found = False
+        ffa_found = False
+        first_templ = None
+        for item in line:
+            if "{{icon" in item.lower():
+                first_templ = item
+                try:
+                    existing_assessment = item.get("1").lower()
+                except ValueError:  # Template may not have parameters
+                    continue
+                if existing_assessment != article_assessment and existing_assessment not in self.no_replace_list and count < 1:  # Don't just change capitalisation, don't replace DGA or FFA
+                    item.add("1", article_assessment.title())
+                dga_found |= (existing_assessment == "dga")
+                ffa_found |= (existing_assessment == "ffa")
+                
+                if (dga_found and article_assessment == "ga") or \
+                    (ffa_found and article_assessment == "fa"):  # Remove DGA template if article is now a GA / FFA if FA
+                    removals.add(id(item))
+                count += 1
+        
+        if first_templ is None:  # Nowhere to put a new icon
+            return
+        # Each new icon goes straight after the first one, so in front of any added before it
+        if (is_dga and not dga_found):
+            insertions.setdefault(id(first_templ), []).insert(0, " {{icon|DGA}}")
+        if (is_ffa and not ffa_found):
+            insertions.setdefault(id(first_templ), []).insert(0, " {{icon|FFA}}")
+
+    # Removes the nodes in removals and adds the text in insertions after the node
+    # it is keyed by, both keyed by node ID. The whole tree is rebuilt in one pass,
+    # rather than searching it again for every edit
+    @staticmethod
+    def apply_icon_edits(wikicode, removals, insertions):
+        if not removals and not insertions:
+            return
+
+        def rebuild(code):
+            nodes = []
+            edited = False
+            for node in code.nodes:
+                for child in node.__children__():  # Icons can be nested in other markup, e.g. {{columns-list}}
+                    rebuild(child)
+                if id(node) in removals:
+                    edited = True
+                else:
+                    nodes.append(node)
+                for text in insertions.get(id(node), []):
+                    nodes.extend(mwparserfromhell.parse(text).nodes)
+                    edited = True
+            if edited:
+                code.nodes[:] = nodes
+
+        rebuild(wikicode)
+
+    # Works out the new header of each top-level heading from the text alone, as
+    # update_section_counts and update_total_count do from the parse tree. Returns the
+    # new text of the heading lines that change, keyed by line number, and the total
+    # article count, or None if the page needs the full parser
+    def stream_section_counts(self, text):
+        headings = []  # [line number, level, header, trailing text, start, numbered, bulleted, quotas]
+        open_headings = []
+        new_lines = {}
+
+        def close(heading, end):
+            number, level, header, trailing, start, numbered, bulleted, quotas = heading
+            old_header_match = SECTION_HEADER_REGEX.match(text, start, end)
+            if old_header_match is None:
+                return True
+            new_header = self.format_section_header(old_header_match, numbered or bulleted, quotas > 0)
+            if old_header_match.group(0).replace(",","") == new_header:
+                return True
+            if old_header_match.group(0) != header:  # Needs a text replace over the section
+                return False
+            heading[2] = new_header
+            new_lines[number] = new_header + trailing
+            return True
+
+        for number, (start, line, kind) in enumerate(scan_lines(text)):
+            if kind is None:
+                return None
+            if kind == "other" and ("{{icon" in line.lower() or "huge" in line.lower() or line.startswith("=")):
+                return None  # Could be a heading or an entry read as part of a template
+
+            if line.startswith("="):
+                heading_match = HEADING_LINE_REGEX.match(line)
+                if heading_match is None or "<!--" in line or "huge" in line.lower():
+                    return None
+                level = len(heading_match.group(1))
+                while open_headings and open_headings[-1][1] >= level:
+                    if not close(open_headings.pop(), start):
+                        return None
+                header = line[:heading_match.end(1) * 2 + len(heading_match.group(2))]
+                heading = [number, level, header, line[len(header):], start, 0, 0, 0]
+                headings.append(heading)
+                open_headings.append(heading)
+
+            if "{{" in line or "quota" in line:
+                numbered = len(NUMBERED_ICON_REGEX.findall(line))
+                bulleted = len(BULLETED_ICON_REGEX.findall(line))
+                quotas = len(QUOTA_REGEX.findall(line))
+                for heading in open_headings:
+                    heading[5] += numbered
+                    heading[6] += bulleted
+                    heading[7] += quotas
+
+        while open_headings:
+            if not close(open_headings.pop(), len(text)):
+                return None
+
+        # Add up the top-level headings' new counts, as update_total_count does
+        total_count = 0
+        if headings:
+            top_level = min(heading[1] for heading in headings)
+            for heading in headings:
+                heading_match = TOTAL_COUNT_REGEX.search(heading[2]) if heading[1] == top_level else None
+                if heading_match is not None:
+                    total_count += int(heading_match.group(1).replace(",",""))
+        return new_lines, total_count
+
+    # Updates the page as the section count and assessment steps of treat_page do, but
+    # a line at a time. Only the lines with icons or {{huge}} on them are parsed, each
+    # on its own, and the new text is written out as it goes, so the page is never held
+    # as a parse tree. Returns None if the page needs the full parser
+    def stream_page(self, text):
+        with self.metrics.phase("stream_scan"):
+            counts = self.stream_section_counts(text)
+        if counts is None:
+            return None
+        new_lines, total_count = counts
+
+        output = io.StringIO()
+        waiting = []  # Lines held back until their articles' assessments are looked up
+        waiting_titles = set()
+
+        def write_waiting():
+            qualities = self.get_vital_article_qualities(waiting_titles) if waiting_titles else {}
+            for item in waiting:
+                if isinstance(item, tuple):
+                    prefix, wikicode, entries = item
+                    removals = set()
+                    insertions = {}
+                    for line, article_title in entries:
+                        self.update_entry_icons(line, qualities[article_title], removals, insertions)
+                    self.apply_icon_edits(wikicode, removals, insertions)
+                    item = prefix + str(wikicode)[1:-1]
+                output.write(item)
+            del waiting[:]
+            waiting_titles.clear()
+
+        with self.metrics.phase("stream_write"):
+            for number, (start, line, kind) in enumerate(scan_lines(text)):
+                prefix = "\n" if number else ""
+                if number in new_lines:
+                    line = new_lines[number]
+                elif kind != "other" and ("huge" in line.lower() or (line.startswith(("#", "*")) and not self.skip_assessment)):
+                    # Parsed with the newlines around it, so that it splits into nodes as it does in the page
+                    wikicode = mwparserfromhell.parse("\n" + line + "\n", skip_style_tags=True)
+                    if "huge" in line.lower():
+                        self.update_huge_templates(wikicode, total_count)
+                    entries = self.get_entries(wikicode) if not self.skip_assessment else []
+                    if entries:
+                        waiting.append((prefix, wikicode, entries))
+                        waiting_titles.update(article_title for entry_line, article_title in entries)
+                        if len(waiting_titles) >= self.stream_batch_size:
+                            write_waiting()
                         continue
-                    article_assessment, is_dga, is_ffa = self.get_vital_article_quality(article_title)
-                    
-                    count = 0
-                    dga_found = False
-                    ffa_found = False
-                    first_templ = None
-                    for item in line:
-                        if "{{icon" in item.lower():
-                            first_templ = item
-                            try:
-                                existing_assessment = item.get("1").lower()
-                            except ValueError:  # Template may not have parameters
-                                continue
-                            if existing_assessment != article_assessment and existing_assessment not in self.no_replace_list and count < 1:  # Don't just change capitalisation, don't replace DGA or FFA
-                                item.add("1", article_assessment.title())
-                            dga_found |= (existing_assessment == "dga")
-                            ffa_found |= (existing_assessment == "ffa")
-                            
-                            if (dga_found and article_assessment == "ga") or \
-                                (ffa_found and article_assessment == "fa"):  # Remove DGA template if article is now a GA / FFA if FA
-                                wikicode.remove(item)
-                            count += 1
-                    
-                    if (is_dga and not dga_found):
-                        wikicode.insert_after(first_templ, " {{icon|DGA}}")
-                    if (is_ffa and not ffa_found):
-                        wikicode.insert_after(first_templ, " {{icon|FFA}}")
+                    line = str(wikicode)[1:-1]
+
+                if waiting:
+                    waiting.append(prefix + line)
+                else:
+                    output.write(prefix + line)
+            write_waiting()
+        return output.getvalue()
+
+    # Notes in the manifest what the page looks like now, and which talk page
+    # revisions each section's assessments came from
+    def record_page(self, wikicode, text, entries, dependencies):
+        if self.manifest is None:
+            return
+        sections = {section_hash: {title: dependencies[title] for line, title in section_entries}
+                    for section_hash, section_entries in self.get_sections(wikicode, entries)}
+        self.manifest.put(self.current_page.title(), self.hash_text(text), sections, not self.skip_assessment)
+
+    def treat_page(self):
+        text = self.current_page.text
+        record = self.manifest.get(self.current_page.title()) if self.manifest is not None else None
+        if record is not None and record["text_hash"] == self.hash_text(text) and (record["assessed"] or self.skip_assessment):
+            # The page is as the bot left it, so only the talk pages can have changed anything
+            dependencies = {}
+            for section_hash, section_dependencies in record["sections"].items():
+                dependencies.update(section_dependencies)
+            if self.skip_assessment or self.source.get_dependencies(list(dependencies)) == dependencies:
+                pywikibot.output("{} is unchanged since the last run".format(self.current_page.title()))
+                return
+
+        wikicode = None
+        entries = []
+        dependencies = {}
+        new_text = self.stream_page(text) if self.streaming else None
+        if new_text is None:
+            if self.streaming:
+                self.metrics.count("streaming_fallbacks")
+                if self.verbose:
+                    pywikibot.output("{} has markup that needs the full parser".format(self.current_page.title()))
+
+            # Parse the page text, unless that was done ahead of time
+            if self.prepared_page is not None and self.prepared_page[0] is self.current_page and self.prepared_page[1] is not None:
+                wikicode = self.prepared_page[1]
+                self.prepared_page = None
+            else:
+                with self.metrics.phase("parse"):
+                    wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
+
+            with self.metrics.phase("section_counts"):
+                self.update_section_counts(wikicode)
+            with self.metrics.phase("total_count"):
+                self.update_total_count(wikicode)
+
+            if self.manifest is not None:
+                with self.metrics.phase("line_grouping"):
+                    entries = self.get_entries(wikicode) if not self.skip_assessment else []
+                dependencies = self.source.get_dependencies(set(title for line, title in entries)) if entries else {}
+                if not self.skip_assessment:
+                    # Sections whose text and talk pages are as they were last time are already up to date
+                    old_sections = record["sections"] if record is not None and record["assessed"] else {}
+                    changed_entries = []
+                    for section_hash, section_entries in self.get_sections(wikicode, entries):
+                        if old_sections.get(section_hash) != {title: dependencies[title] for line, title in section_entries}:
+                            changed_entries.extend(section_entries)
+                    with self.metrics.phase("assessments"):
+                        self.update_assessments(wikicode, changed_entries)
+            elif not self.skip_assessment:
+                with self.metrics.phase("line_grouping"):
+                    entries = self.get_entries(wikicode)
+                with self.metrics.phase("assessments"):
+                    self.update_assessments(wikicode, entries)
+
+            new_text = str(wikicode)
+
+        if new_text == text:
+            pywikibot.output("No changes needed on {}".format(self.current_page.title()))
+            self.record_page(wikicode, new_text, entries, dependencies)
+            return
 
         if (self.check_task_switch_is_on()):
             # Save the updated text to the page
-            self.put_current(str(wikicode),
-                            summary="([[Wikipedia:Bots/Requests for approval/Bot0612 9|BOT]]) Updating section counts{}".format(" and WikiProject assessments" if not self.skip_assessment else ""))
+            summary = "([[Wikipedia:Bots/Requests for approval/Bot0612 9|BOT]]) Updating section counts{}".format(" and WikiProject assessments" if not self.skip_assessment else "")
+            with self.metrics.phase("save"):
+                if self.pipeline:  # Queue the save and move on; queued saves still follow the edit throttle
+                    self.put_current(new_text, summary=summary, asynchronous=True)
+                else:
+                    self.put_current(new_text, summary=summary)
+            self.record_page(wikicode, new_text, entries, dependencies)
         else:
             print("Switch for task {} is off, terminating".format(self.task_number))
-            exit(1)
+            self.switched_off = True  # Stops the run before the next page
 
-def main(*args):
+def create_bot(*local_args):
     """
-    Process command line arguments and invoke bot.
+    Process the bot's own command line arguments and create the bot.
 
-    If args is an empty list, sys.argv is used.
-
-    @param args: command line arguments
-    @type args: list of unicode
+    @param local_args: command line arguments left over by
+        pywikibot.handle_args
+    @type local_args: list of unicode
+    @return: the bot, or None if there is no bot to run
+    @rtype: VitalArticlesBot
     """
     options = {}
-    # Process global arguments to determine desired site
-    local_args = pywikibot.handle_args(args)
 
     # This factory is responsible for processing command line arguments
     # that are also used by other scripts and that determine on which pages
@@ -318,7 +1353,7 @@ def main(*args):
         # Now pick up your own options
         arg, sep, value = arg.partition(':')
         option = arg[1:]
-        if option in ('summary', 'text'):
+        if option in ('summary', 'text', 'cachefile', 'cacheexpiry', 'workers', 'dump', 'source', 'memosize', 'manifest', 'record', 'replay', 'metrics', 'prometheus', 'switchinterval', 'maxrate'):
             if not value:
                 pywikibot.input('Please enter a value for ' + arg)
             options[option] = value
@@ -332,12 +1367,29 @@ def main(*args):
     gen = genFactory.getCombinedGenerator(preload=True)
     if gen:
         # pass generator and private options to the bot
-        bot = VitalArticlesBot(gen, **options)
-        bot.run()  # guess what it does
-        return True
+        return VitalArticlesBot(gen, **options)
     else:
         pywikibot.bot.suggest_help(missing_generator=True)
+        return None
+
+
+def main(*args):
+    """
+    Process command line arguments and invoke bot.
+
+    If args is an empty list, sys.argv is used.
+
+    @param args: command line arguments
+    @type args: list of unicode
+    """
+    # Process global arguments to determine desired site
+    bot = create_bot(*pywikibot.handle_args(args))
+    if bot is None:
         return False
+    bot.run()  # guess what it does
+    if bot.switched_off:
+        exit(1)
+    return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,989 @@
+#!/usr/bin/env python3
+"""
+The base that Firefly's bot tasks share, e.g. task 9 and the G8 patrol.
+
+FireflyBot handles the options every task takes, its task switch, API
+cassettes and metrics. The RequestScheduler shares one budget of API requests
+between every task running in the process; run_tasks() runs several tasks at
+once.
+
+Run as a script, it runs several task scripts in one process. Each -task:
+argument names a script, and is followed by that script's own arguments:
+
+    python fireflybot.py -lang:en -task:VitalArticlesBot/update_vital_article_counts.py -always
+        -task:G8PatrolBot/g8_patrol_bot.py -shards:4
+
+Global arguments, e.g. -lang: and -simulate, apply to every task.
+"""
+#
+# (C) Pywikibot team, 2006-2018
+# (C) Richard Jenkins (firefly) 2018
+#
+# Distributed under the terms of the MIT license.
+#
+from __future__ import absolute_import, unicode_literals
+from collections import Counter, deque
+from contextlib import contextmanager
+import gzip
+import importlib
+import json
+import os
+import requests
+import sys
+import threading
+import time
+
+import pywikibot
+from pywikibot.comms import http
+from pywikibot.data import api
+from pywikibot.throttle import Throttle
+
+from pywikibot.bot import SingleSiteBot, ExistingPageBot, NoRedirectPageBot
+from pywikibot.tools import issue_deprecation_warning
+
+
+# The task each thread is working for. Several tasks can run in one process,
+# and the hooks one of them installs only act on that task's own threads
+thread_tasks = threading.local()
+
+
+def set_thread_task(task):
+    thread_tasks.task = task
+
+
+def thread_task():
+    return getattr(thread_tasks, "task", None)
+
+
+def belongs_to(task):
+    """
+    Whether a call made on the current thread is one of task's.
+
+    Threads that no task has claimed, e.g. ones pywikibot starts itself, are
+    treated as belonging to every task.
+
+    @param task: the task to check for, or None for any task
+    @type task: FireflyBot
+    @rtype: bool
+    """
+    current = thread_task()
+    return task is None or current is None or current is task
+
+
+class HookRegistry(object):
+    """
+    Lets several hooks wrap the same pywikibot function without undoing each other.
+
+    A hooked function is replaced once, by a wrapper that runs its hooks in
+    order, lowest order first. Each hook is called as hook(call, *args,
+    **kwargs) and returns the result, calling call(*args, **kwargs) to go on
+    to the next hook, or to the original function after the last one. Hooks
+    can be removed in any order, and the original function is put back once
+    the last one is gone.
+
+    There is one registry per process. Use shared() to get it.
+    """
+
+    instance = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chains = {}  # (owner, name): (original function, [(order, hook)])
+        self.scheduler = None  # The process's RequestScheduler, made when first needed
+
+    @staticmethod
+    def shared():
+        if HookRegistry.instance is None:
+            HookRegistry.instance = HookRegistry()
+        return HookRegistry.instance
+
+    def add(self, owner, name, hook, order):
+        with self.lock:
+            original, hooks = self.chains.get((owner, name), (None, []))
+            if original is None:
+                original = getattr(owner, name)
+                registry = self
+
+                def wrapper(*args, **kwargs):
+                    return registry.call(owner, name, *args, **kwargs)
+
+                setattr(owner, name, wrapper)
+            self.chains[(owner, name)] = (original, sorted(hooks + [(order, hook)], key=lambda entry: entry[0]))
+
+    def remove(self, owner, name, hook):
+        with self.lock:
+            original, hooks = self.chains[(owner, name)]
+            hooks = [(order, other) for order, other in hooks if other != hook]
+            if hooks:
+                self.chains[(owner, name)] = (original, hooks)
+            else:
+                del self.chains[(owner, name)]
+                setattr(owner, name, original)
+
+    def call(self, owner, name, *args, **kwargs):
+        chain = self.chains.get((owner, name))
+        if chain is None:  # The last hook was removed while this call was on its way
+            return getattr(owner, name)(*args, **kwargs)
+        original, hooks = chain
+
+        def call_from(index, *args, **kwargs):
+            if index == len(hooks):
+                return original(*args, **kwargs)
+            return hooks[index][1](lambda *args, **kwargs: call_from(index + 1, *args, **kwargs), *args, **kwargs)
+
+        return call_from(0, *args, **kwargs)
+
+
+class APICassette(object):
+    """
+    Records every API request and its response to a file, or plays them back.
+
+    The file is gzipped JSON lines, one request per line. When playing back,
+    each request is answered with the response recorded for the same
+    parameters, in the order they were recorded, and nothing is sent to the
+    wiki. A request that wasn't recorded, e.g. an edit with different text,
+    is an error.
+
+    When the bot running it is given as task, requests made by other tasks'
+    threads pass straight through.
+    """
+
+    # Left out of recordings. They differ between sessions without changing the response
+    ignored_parameters = ["token", "lgtoken", "lgpassword", "password"]
+    order = 20  # Hook order, inside the metrics hook so replayed requests are still counted
+
+    def __init__(self, filename, replay=False, task=None):
+        """
+        Constructor.
+
+        @param filename: path of the cassette file
+        @type filename: unicode
+        @param replay: whether to play the cassette back rather than record it
+        @type replay: bool
+        @param task: the bot whose requests go through the cassette; all
+            requests by default
+        @type task: FireflyBot
+        """
+        self.filename = filename
+        self.replay = replay
+        self.task = task
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.responses = {}
+        self.file = None
+        self.installed = False
+        if replay:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.responses.setdefault(self.key(entry["request"]), deque()).append(entry)
+        else:
+            self.file = gzip.open(filename, "wt", encoding="utf-8")
+
+    def key(self, parameters):
+        return json.dumps(parameters, sort_keys=True)
+
+    # Names the kind of request, e.g. "action=query prop=info", for the summary
+    @staticmethod
+    def describe(parameters):
+        return " ".join("{}={}".format(name, "|".join(parameters[name]))
+                        for name in ("action", "prop", "list", "meta", "generator") if name in parameters)
+
+    # Sends every API request through the cassette until close() is called
+    def install(self):
+        HookRegistry.shared().add(api.Request, "submit", self.submit, self.order)
+        HookRegistry.shared().add(api.CachedRequest, "_load_cache", self.load_cache, self.order)
+        self.installed = True
+
+    # pywikibot answers requests such as siteinfo and paraminfo from its own cache
+    # when it can, without submitting them. While the cassette is in use they are
+    # always submitted, so that a recording doesn't depend on what was cached
+    def load_cache(self, original_load_cache, request):
+        cached = original_load_cache(request)  # Also adds the request's default parameters
+        return cached and not belongs_to(self.task)
+
+    def submit(self, original_submit, request):
+        if not belongs_to(self.task):
+            return original_submit(request)
+        parameters = {name: [str(value) for value in request[name]] for name in request
+                      if name not in self.ignored_parameters}
+        with self.lock:
+            self.counts[self.describe(parameters)] += 1
+
+        if self.replay:
+            with self.lock:
+                recorded = self.responses.get(self.key(parameters))
+                if not recorded:
+                    raise pywikibot.exceptions.Error("Request is not in the cassette: {}".format(self.key(parameters)))
+                entry = recorded.popleft()
+            if "error" in entry:
+                raise pywikibot.exceptions.APIError(entry["error"]["code"], entry["error"]["info"], **entry["error"]["other"])
+            return entry["response"]
+
+        try:
+            response = original_submit(request)
+        except pywikibot.exceptions.APIError as e:
+            self.write({"request": parameters, "error": {"code": e.code, "info": e.info, "other": e.other}})
+            raise
+        self.write({"request": parameters, "response": response})
+        return response
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        if self.installed:
+            HookRegistry.shared().remove(api.Request, "submit", self.submit)
+            HookRegistry.shared().remove(api.CachedRequest, "_load_cache", self.load_cache)
+            self.installed = False
+        if self.file is not None:
+            self.file.close()
+        for description, count in self.counts.most_common():
+            pywikibot.output("{:>6} {}".format(count, description))
+
+
+class BotMetrics(object):
+    """
+    Times the phases of a run and counts what happened in it.
+
+    Counts are kept for the whole run and for each page. Phases can be
+    nested, e.g. the "api" phase happens inside "talk_fetch", so their times
+    don't add up to the length of the run. install() adds the API, network,
+    retry and throttle phases by hooking those parts of pywikibot. Given a
+    task, only the calls made by that task's threads are timed.
+    """
+
+    order = 10  # Hook order, outermost so that everything inside is timed
+
+    def __init__(self, task=None):
+        self.lock = threading.Lock()
+        self.task = task
+        self.started = time.time()
+        self.phases = {}  # name: [seconds, times entered]
+        self.counters = Counter()
+        self.page_counters = {}
+        self.page = None  # Title of the page being treated, which counts are also added to
+        self.patched = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, [0.0, 0])
+                phase[0] += seconds
+                phase[1] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+            if self.page is not None:
+                self.page_counters.setdefault(self.page, Counter())[name] += amount
+
+    # Hooks owner.name so that every call is timed as a phase and counted.
+    # If given, measure(result) is added to the measure_counter count too
+    def wrap(self, owner, name, phase, counter, measure=None, measure_counter=None):
+        metrics = self
+
+        def hook(call, *args, **kwargs):
+            if not belongs_to(metrics.task):
+                return call(*args, **kwargs)
+            metrics.count(counter)
+            with metrics.phase(phase):
+                result = call(*args, **kwargs)
+            if measure is not None:
+                metrics.count(measure_counter, measure(result))
+            return result
+
+        HookRegistry.shared().add(owner, name, hook, self.order)
+        self.patched.append((owner, name, hook))
+
+    @staticmethod
+    def response_size(response):
+        # Older pywikibot returns the response text rather than a response object
+        content = getattr(response, "content", response)
+        return len(content) if content is not None else 0
+
+    def install(self):
+        self.wrap(api.Request, "submit", "api", "api_requests")
+        self.wrap(api.Request, "wait", "retry_wait", "api_retries")
+        self.wrap(http, "request", "network", "http_requests", self.response_size, "bytes_received")
+        self.wrap(Throttle, "__call__", "throttle", "throttle_checks")
+
+    def uninstall(self):
+        while self.patched:
+            owner, name, hook = self.patched.pop()
+            HookRegistry.shared().remove(owner, name, hook)
+
+    def summary(self, task_number):
+        return {
+            "task": task_number,
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "phases": {name: {"seconds": seconds, "count": count} for name, (seconds, count) in self.phases.items()},
+            "counters": dict(self.counters),
+            "pages": {title: dict(counters) for title, counters in self.page_counters.items()},
+        }
+
+    def write_json(self, filename, task_number):
+        with open(filename, "w") as f:
+            json.dump(self.summary(task_number), f, indent=2, sort_keys=True)
+
+    # Writes the totals in the Prometheus text format, for node_exporter's textfile collector
+    def write_prometheus(self, filename, task_number):
+        lines = [
+            "# HELP fireflybot_run_seconds How long the last run took",
+            "# TYPE fireflybot_run_seconds gauge",
+            'fireflybot_run_seconds{{task="{}"}} {}'.format(task_number, time.time() - self.started),
+            "# HELP fireflybot_last_run_timestamp_seconds When the last run started",
+            "# TYPE fireflybot_last_run_timestamp_seconds gauge",
+            'fireflybot_last_run_timestamp_seconds{{task="{}"}} {}'.format(task_number, self.started),
+            "# HELP fireflybot_phase_seconds Time spent in each phase of the last run",
+            "# TYPE fireflybot_phase_seconds gauge",
+        ]
+        for name, (seconds, count) in sorted(self.phases.items()):
+            lines.append('fireflybot_phase_seconds{{task="{}",phase="{}"}} {}'.format(task_number, name, seconds))
+        lines += [
+            "# HELP fireflybot_events Number of each kind of event in the last run",
+            "# TYPE fireflybot_events gauge",
+        ]
+        for name, count in sorted(self.counters.items()):
+            lines.append('fireflybot_events{{task="{}",event="{}"}} {}'.format(task_number, name, count))
+
+        # The collector may read the file at any time, so replace it in one go
+        with open(filename + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(filename + ".tmp", filename)
+
+
+class TaskSwitchWatcher(object):
+    """
+    Keeps track of whether a task's switch page says "active".
+
+    The page's latest revision ID is looked up every interval seconds on a
+    background thread, and its text is only downloaded again when that has
+    changed. is_on can be read at any time without waiting for the wiki.
+
+    If the page can't be checked for stale_intervals intervals in a row, the
+    switch counts as off until a check succeeds again, so a task can't keep
+    running unnoticed once its switch page is out of reach.
+    """
+
+    stale_intervals = 3
+
+    def __init__(self, site, title, interval=60, task=None):
+        """
+        Constructor.
+
+        @param site: the site the switch page is on
+        @type site: pywikibot.site.APISite
+        @param title: title of the switch page
+        @type title: unicode
+        @param interval: seconds between checks
+        @type interval: float
+        @param task: the bot whose switch it is, which the checks are made for
+        @type task: FireflyBot
+        """
+        self.site = site
+        self.task = task
+        self.title = title
+        self.interval = interval
+        self.revision_id = None
+        self.active = False  # Whether the page said "active" when it was last checked
+        self.refreshed = 0.0  # When the page was last checked successfully
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Checks the page now, timed as the task's task_switch_check phase
+    def refresh(self):
+        if self.task is None:
+            self.check()
+            return
+        with self.task.metrics.phase("task_switch_check"):
+            self.check()
+
+    def check(self):
+        data = api.Request(site=self.site, parameters={"action": "query", "prop": "info", "titles": self.title}).submit()
+        revision_id = next(iter(data["query"]["pages"].values())).get("lastrevid", 0)
+        if revision_id != self.revision_id:
+            self.active = pywikibot.Page(self.site, self.title).text.strip() == "active"
+            self.revision_id = revision_id
+        self.refreshed = time.time()
+
+    @property
+    def is_on(self):
+        return self.active and time.time() - self.refreshed <= self.stale_intervals * self.interval
+
+    def watch(self):
+        set_thread_task(self.task)
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except pywikibot.exceptions.Error as e:  # Keep the last known state for a while, in case the wiki answers again
+                pywikibot.warning("Could not check {}: {}".format(self.title, e))
+
+    # Checks the switch once before returning, then keeps checking in the background
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=self.watch, name="Task switch watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class FireflyBot(
+    SingleSiteBot,  # A bot only working on one site
+    ExistingPageBot,  # CurrentPageBot which only treats existing pages
+    NoRedirectPageBot,  # CurrentPageBot which only treats non-redirects
+):
+    has_task_switch = True  # False for tasks that may run without a switch page
+
+    # pywikibot 6 renamed the bot option API. The tasks keep using the older
+    # names, which are provided here when pywikibot no longer has them
+    if not hasattr(SingleSiteBot, "availableOptions"):
+        @property
+        def availableOptions(self):
+            return self.available_options
+
+        @property
+        def options(self):
+            return self.opt
+
+        def getOption(self, option):
+            return self.opt[option]
+
+    def __init__(self, generator, **kwargs):
+        """
+        Constructor.
+
+        @param generator: the page generator that determines on which pages
+            to work
+        @type generator: generator
+        """
+        # Add your own options to the bot and set their defaults
+        # -always option is predefined by BaseBot class
+        self.availableOptions.update({
+            'replace': False,  # delete old text and write the new text
+            'summary': None,  # your own bot summary
+            'text': 'Test',  # add this text from option. 'Test' is default
+            'top': False,  # append text on top of the page
+            'record': None,  # cassette file to record API requests to
+            'replay': None,  # cassette file to answer API requests from
+            'metrics': None,  # JSON file to write timings and counts to
+            'prometheus': None,  # Prometheus textfile to write timings and counts to
+            'switchinterval': 60,  # seconds between background checks of the task switch
+            'maxrate': None,  # API requests per second allowed across every task in the process
+        })
+        
+        self.task_number = -1
+        self.check_page = "User:Bot0612/shutoff/{}"
+        self.task_switch = None
+        self.switched_off = False
+
+        # call constructor of the super class
+        super(FireflyBot, self).__init__(site=True, **kwargs)
+
+        # handle old -dry parameter
+        self._handle_dry_param(**kwargs)
+
+        # assign the generator to the bot
+        self.generator = generator
+
+        self.cassette = None
+        self.metrics = BotMetrics(self)
+        self.scheduler = RequestScheduler.shared()
+        self.scheduler_threads = 0
+        self.hooked = False
+        self.saves_lock = threading.Condition()
+        self.pending_saves = 0  # Saves queued with asynchronous=True that haven't finished yet
+
+    # How many threads the bot makes API requests from at once
+    @property
+    def request_threads(self):
+        return 1
+
+    # Starts the cassette and metrics hooks the options ask for. This is left until
+    # the bot runs, so that a bot that is made but never run changes nothing
+    def install_hooks(self):
+        if self.getOption("record") or self.getOption("replay"):
+            self.cassette = APICassette(self.getOption("replay") or self.getOption("record"), replay=bool(self.getOption("replay")), task=self)
+            self.cassette.install()
+        if self.getOption("metrics") or self.getOption("prometheus"):
+            self.metrics.install()
+
+    def run(self):
+        # Requests made on this thread, and on the threads it starts, are this task's
+        set_thread_task(self)
+        self.install_hooks()
+        HookRegistry.shared().add(pywikibot, "async_request", self.async_request_hook, 0)
+        self.hooked = True
+        # Share the request budget with any other tasks running in this process
+        self.scheduler_threads = self.request_threads
+        self.scheduler.start_task(self.scheduler_threads, self.getOption("maxrate"), coalesce=self.cassette is None)
+        interval = float(self.getOption("switchinterval"))
+        if self.has_task_switch and interval > 0:
+            self.task_switch = TaskSwitchWatcher(self.site, self.check_page.format(self.task_number), interval, self)
+            self.task_switch.start()
+        self.generator = self.until_switched_off(self.generator)
+        super(FireflyBot, self).run()
+
+    # Starts a background thread working for this task
+    def start_thread(self, target, name, *args):
+        def run():
+            set_thread_task(self)
+            target(*args)
+
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True  # Don't hold up an exit while it is still working
+        thread.start()
+        return thread
+
+    # Pages saved with asynchronous=True are saved on pywikibot's own thread,
+    # as this task
+    def async_request_hook(self, async_request, request, *args, **kwargs):
+        if thread_task() is not self:
+            return async_request(request, *args, **kwargs)
+
+        def attributed(*args, **kwargs):
+            set_thread_task(self)
+            try:
+                return request(*args, **kwargs)
+            finally:
+                set_thread_task(None)
+                with self.saves_lock:
+                    self.pending_saves -= 1
+                    self.saves_lock.notify_all()
+
+        with self.saves_lock:
+            self.pending_saves += 1
+        return async_request(attributed, *args, **kwargs)
+
+    # Ends the run before the next page once the task's switch has been turned off,
+    # letting the page being worked on finish first
+    def until_switched_off(self, pages):
+        for page in pages:
+            if not self.switched_off and self.task_switch is not None and not self.task_switch.is_on:
+                print("Switch for task {} is off, terminating".format(self.task_number))
+                self.switched_off = True
+            if self.switched_off:
+                return
+            yield page
+
+    def treat(self, page):
+        self.metrics.page = page.title()
+        try:
+            with self.metrics.phase("treat_page"):
+                super(FireflyBot, self).treat(page)
+        finally:
+            self.metrics.page = None
+
+    def teardown(self):
+        # This task's saves still waiting on pywikibot's thread are counted and
+        # recorded too. Other tasks' saves are left to finish on their own
+        with self.saves_lock:
+            while self.pending_saves:
+                self.saves_lock.wait()
+        if self.hooked:
+            HookRegistry.shared().remove(pywikibot, "async_request", self.async_request_hook)
+            self.hooked = False
+        if self.task_switch is not None:
+            self.task_switch.stop()
+        if self.scheduler_threads:
+            self.scheduler.finish_task(self.scheduler_threads, coalesce=self.cassette is None)
+            self.scheduler_threads = 0
+        self.metrics.uninstall()
+        if self.getOption("metrics"):
+            self.metrics.write_json(self.getOption("metrics"), self.task_number)
+        if self.getOption("prometheus"):
+            self.metrics.write_prometheus(self.getOption("prometheus"), self.task_number)
+        if self.cassette is not None:
+            pywikibot.output("API requests made:")
+            self.cassette.close()
+            self.cassette = None
+        super(FireflyBot, self).teardown()
+
+    @property
+    def title_batch_size(self):
+        # The API accepts 500 titles per query for bots, 50 otherwise
+        return 500 if self.site.has_right("apihighlimits") else 50
+
+    def query_titles(self, titles, batch_size=None, **params):
+        """
+        Run an action=query request over many titles, in batches.
+
+        Small batches may be merged with other threads' queries by the
+        RequestScheduler.
+
+        @param titles: the page titles to query
+        @type titles: iterable of unicode
+        @param batch_size: titles per request; title_batch_size by default
+        @type batch_size: int
+        @return: the 'query' part of each API response, following continuations
+        @rtype: generator of dict
+        """
+        titles = list(titles)
+        batch_size = batch_size or self.title_batch_size
+        for i in range(0, len(titles), batch_size):
+            for query in self.scheduler.query(self.site, titles[i:i + batch_size], params, batch_size):
+                yield query
+
+    def check_task_switch_is_on(self):
+        if not self.has_task_switch:
+            return True
+        if self.task_switch is not None:  # Kept up to date in the background
+            return self.task_switch.is_on
+        with self.metrics.phase("task_switch_check"):
+            check_page = pywikibot.Page(self.site, self.check_page.format(self.task_number))
+            return (check_page.text.strip() == "active")
+        
+    def _handle_dry_param(self, **kwargs):
+        """
+        Read the dry parameter and set the simulate variable instead.
+
+        This is a private method. It prints a deprecation warning for old
+        -dry paramter and sets the global simulate variable and informs
+        the user about this setting.
+
+        The constuctor of the super class ignores it because it is not
+        part of self.availableOptions.
+
+        @note: You should ommit this method in your own application.
+
+        @keyword dry: deprecated option to prevent changes on live wiki.
+            Use -simulate instead.
+        @type dry: bool
+        """
+        if 'dry' in kwargs:
+            issue_deprecation_warning('dry argument',
+                                      'pywikibot.config.simulate', 1)
+            # use simulate variable instead
+            pywikibot.config.simulate = True
+            pywikibot.output('config.simulate was set to True')
+
+    def treat_page(self):
+        pass
+
+
+class RateLimiter(object):
+    """
+    Spaces out API requests made from several threads.
+
+    Each thread calls wait() before making a request. When the server reports
+    lag or fails, backoff() increases the gap between requests (doubling it up
+    to max_delay); every successful request then halves it again.
+    """
+
+    def __init__(self, delay=0.0, max_delay=120.0):
+        self.lock = threading.Lock()
+        self.min_delay = delay
+        self.delay = delay
+        self.max_delay = max_delay
+        self.next_request = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            sleep_for = max(0.0, self.next_request - now)
+            self.next_request = max(now, self.next_request) + self.delay
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+    def backoff(self, seconds=None):
+        with self.lock:
+            self.delay = min(self.max_delay, max(self.delay * 2, seconds or 1.0))
+            self.next_request = time.time() + self.delay
+
+    def success(self):
+        with self.lock:
+            self.delay = max(self.min_delay, self.delay / 2)
+
+
+class RequestScheduler(object):
+    """
+    Shares one budget of API requests between every bot running in the process.
+
+    Every request, from any thread or task, waits its turn on one RateLimiter.
+    Its gap widens whenever pywikibot has to wait for the wiki (maxlag,
+    Retry-After and rate limit responses, failed requests) and narrows again
+    as requests succeed, so all the threads slow down together rather than
+    each finding out on its own. Small title queries that pile up while a
+    query with the same parameters is on its way are merged into one
+    multi-title query by query(), and the connection pool is made big enough
+    for every thread to keep its connection to the wiki alive between
+    requests.
+
+    There is one scheduler per process, kept with the HookRegistry. Use
+    shared() to get it.
+    """
+
+    order = 30  # Hook order, inside the metrics and cassette hooks so replayed requests don't wait
+    pool_size = 10  # connections requests keeps per host unless told otherwise
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiter = RateLimiter()
+        self.tasks = 0
+        self.threads = 0
+        self.recording_tasks = 0  # tasks with a cassette, whose queries mustn't depend on timing
+        self.answered = threading.Condition(self.lock)  # Notified whenever a merged query is answered
+        self.sending = set()  # (site ID, parameters) of the merged queries on their way
+        self.queued = {}  # (site ID, parameters): [[titles, answered, query parts, error]]
+
+    @staticmethod
+    def shared():
+        registry = HookRegistry.shared()
+        with registry.lock:
+            if registry.scheduler is None:
+                registry.scheduler = RequestScheduler()
+            return registry.scheduler
+
+    def start_task(self, threads=1, max_rate=None, coalesce=True):
+        """
+        Note that a bot is starting to make requests.
+
+        @param threads: how many threads the bot makes requests from
+        @type threads: int
+        @param max_rate: the most requests per second the bot allows; the
+            lowest of all the running bots' rates applies to every request
+        @type max_rate: float
+        @param coalesce: whether the bot's queries may be merged with others
+        @type coalesce: bool
+        """
+        with self.lock:
+            self.tasks += 1
+            self.threads += threads
+            self.recording_tasks += not coalesce
+            first = self.tasks == 1
+            pool_size = self.threads + self.tasks  # Each task's task switch watcher too
+        if first:
+            registry = HookRegistry.shared()
+            registry.add(api.Request, "submit", self.submit_hook, self.order)
+            registry.add(api.Request, "wait", self.wait_hook, self.order)
+            registry.add(Throttle, "lag", self.lag_hook, self.order)
+        if max_rate:
+            self.limit(float(max_rate))
+        if pool_size > self.pool_size:
+            self.pool_size = pool_size
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            http.session.mount("https://", adapter)
+            http.session.mount("http://", adapter)
+
+    def finish_task(self, threads=1, coalesce=True):
+        with self.lock:
+            self.tasks -= 1
+            self.threads -= threads
+            self.recording_tasks -= not coalesce
+            last = self.tasks == 0
+        if last:
+            registry = HookRegistry.shared()
+            registry.remove(api.Request, "submit", self.submit_hook)
+            registry.remove(api.Request, "wait", self.wait_hook)
+            registry.remove(Throttle, "lag", self.lag_hook)
+            self.limiter = RateLimiter()
+
+    # Keeps requests at least 1 / max_rate seconds apart
+    def limit(self, max_rate):
+        with self.limiter.lock:
+            self.limiter.min_delay = max(self.limiter.min_delay, 1.0 / max_rate)
+            self.limiter.delay = max(self.limiter.delay, self.limiter.min_delay)
+
+    # pywikibot retries failed requests itself, so each attempt only waits its turn
+    def submit_hook(self, submit, request):
+        self.limiter.wait()
+        result = submit(request)
+        self.limiter.success()
+        return result
+
+    # pywikibot waits like this before retrying a failed or rate limited request
+    def wait_hook(self, wait, request, *args, **kwargs):
+        self.limiter.backoff(args[0] if args else kwargs.get("delay"))
+        return wait(request, *args, **kwargs)
+
+    # and like this when the wiki reports lag, for as long as any Retry-After header says
+    def lag_hook(self, lag, throttle, *args, **kwargs):
+        self.limiter.backoff(getattr(throttle, "retry_after", 0) or (args[0] if args else kwargs.get("lagtime")))
+        return lag(throttle, *args, **kwargs)
+
+    def query(self, site, titles, parameters, batch_size):
+        """
+        Run an action=query request for some titles, following continuations.
+
+        A query for fewer than batch_size titles is sent straight away unless
+        a query with the same parameters is already on its way. Then it waits
+        for that one to come back, and is sent as one with every other query
+        that has queued up meanwhile. Each caller only gets back the pages,
+        normalisations and redirects for its own titles.
+
+        @param site: the site to query
+        @type site: pywikibot.site.APISite
+        @param titles: the page titles to query, at most batch_size of them
+        @type titles: list of unicode
+        @param parameters: the other parameters of the query
+        @type parameters: dict
+        @param batch_size: the most titles to send in one request
+        @type batch_size: int
+        @return: the 'query' part of each API response
+        @rtype: list of dict
+        """
+        if len(titles) >= batch_size or self.recording_tasks:
+            return self.send_query(site, titles, parameters)
+
+        key = (id(site), json.dumps(parameters, sort_keys=True, default=str))
+        waiter = [titles, False, None, None]
+        with self.lock:
+            self.queued.setdefault(key, []).append(waiter)
+            while key in self.sending and not waiter[1]:
+                self.answered.wait()
+            if waiter[1]:  # Another thread sent it along with its own
+                if waiter[3] is not None:
+                    raise waiter[3]
+                return waiter[2]
+            waiters = self.queued.pop(key)
+            self.sending.add(key)
+
+        try:
+            merged = []
+            seen = set()
+            for other in waiters:
+                merged.extend(title for title in other[0] if title not in seen)
+                seen.update(other[0])
+            parts = []
+            for i in range(0, len(merged), batch_size):
+                parts.extend(self.send_query(site, merged[i:i + batch_size], parameters))
+            for other in waiters:
+                other[2] = parts if len(waiters) == 1 else self.split_query(parts, other[0])
+        except Exception as e:
+            for other in waiters:
+                if other is not waiter:
+                    other[3] = e
+            raise
+        finally:
+            with self.lock:
+                for other in waiters:
+                    other[1] = True
+                self.sending.discard(key)
+                self.answered.notify_all()
+        return waiter[2]
+
+    @staticmethod
+    def send_query(site, titles, parameters):
+        parameters = dict(parameters, action="query", titles=titles)
+        parts = []
+        while True:
+            data = api.Request(site=site, parameters=parameters).submit()
+            parts.append(data.get("query", {}))
+            if "continue" not in data:
+                return parts
+            parameters.update(data["continue"])
+
+    # Picks out of a merged query the parts about the given titles, following
+    # them through normalisation and redirects
+    @staticmethod
+    def split_query(parts, titles):
+        wanted = set(titles)
+        split = []
+        for part in parts:
+            part = dict(part)
+            for name in ("normalized", "converted", "redirects"):
+                if name in part:
+                    part[name] = [entry for entry in part[name] if entry["from"] in wanted]
+                    wanted.update(entry["to"] for entry in part[name])
+            pages = part.get("pages")
+            if isinstance(pages, dict):
+                part["pages"] = {page_id: page for page_id, page in pages.items() if page.get("title") in wanted}
+            elif pages is not None:  # formatversion=2
+                part["pages"] = [page for page in pages if page.get("title") in wanted]
+            split.append(part)
+        return split
+
+
+def run_tasks(bots):
+    """
+    Run several bots at once in this process, e.g. task 9 and the G8 patrol.
+
+    Each bot runs on its own thread. They share the process's
+    RequestScheduler, so all of their requests fit in one budget, and reads
+    that pile up behind each other can be merged.
+
+    @param bots: the bots to run
+    @type bots: list of FireflyBot
+    """
+    # pywikibot.stopme() empties the queue of saves made with asynchronous=True,
+    # which every task shares. Each bot calls it as it finishes, so it is held
+    # back until every task has finished, and left for the caller to call then
+    def after_every_task(stopme):
+        pass
+
+    HookRegistry.shared().add(pywikibot, "stopme", after_every_task, 0)
+    try:
+        threads = []
+        for bot in bots:
+            thread = threading.Thread(target=bot.run, name="Task {}".format(bot.task_number))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        HookRegistry.shared().remove(pywikibot, "stopme", after_every_task)
+
+
+# Imports a task script, given its path from the working directory or this one
+def import_task(path):
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    directory, filename = os.path.split(os.path.abspath(path))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(os.path.splitext(filename)[0])
+
+
+def main(*args):
+    """
+    Process command line arguments and run each task's bot.
+
+    If args is an empty list, sys.argv is used.
+
+    @param args: command line arguments
+    @type args: list of unicode
+    """
+    # Process global arguments to determine desired site
+    local_args = pywikibot.handle_args(args)
+
+    # Each -task: argument starts the arguments of another task
+    tasks = []
+    for arg in local_args:
+        if arg.startswith("-task:"):
+            tasks.append((arg[len("-task:"):], []))
+        elif tasks:
+            tasks[-1][1].append(arg)
+        else:
+            pywikibot.error("{} comes before any -task: argument".format(arg))
+            return False
+    if not tasks:
+        pywikibot.bot.suggest_help(additional_text="Name the tasks to run with -task:")
+        return False
+
+    bots = []
+    for path, task_args in tasks:
+        bot = import_task(path).create_bot(*task_args)
+        if bot is None:
+            return False
+        bots.append(bot)
+    run_tasks(bots)
+    pywikibot.stopme()
+    if any(bot.switched_off for bot in bots):
+        exit(1)
+    return True
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# The tests never talk to a wiki. pywikibot gets a user-config.py of its own,
+# in a directory that also takes its caches and cookies, and doesn't slow
+# down between requests or edits
+base_dir = tempfile.mkdtemp(prefix="fireflybot-tests-")
+with open(os.path.join(base_dir, "user-config.py"), "w") as f:
+    f.write("family = 'wikipedia'\nmylang = 'en'\nput_throttle = 0\nminthrottle = 0\nmaxthrottle = 0\n")
+os.environ["PYWIKIBOT_DIR"] = base_dir
+os.environ.pop("PYWIKIBOT_NO_USER_CONFIG", None)
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, "VitalArticlesBot"), os.path.join(root, "G8PatrolBot"), root]
@@ -0,0 +1,322 @@
+"""
+A tiny wiki that answers pywikibot's API requests, so bots can be run offline.
+
+StubWiki.install() hooks api.Request.submit through the HookRegistry, inside
+every other hook, so the bots' own scheduler, metrics and cassette hooks see
+the requests just as they would with the real wiki. Only the parts of the API
+that the bots use are answered.
+"""
+import itertools
+import re
+import threading
+import unittest
+
+import pywikibot
+from pywikibot.data import api
+
+from fireflybot import HookRegistry
+
+
+NAMESPACES = {
+    -2: "Media", -1: "Special", 0: "", 1: "Talk", 2: "User", 3: "User talk", 4: "Wikipedia", 5: "Wikipedia talk",
+    6: "File", 7: "File talk", 8: "MediaWiki", 9: "MediaWiki talk", 10: "Template", 11: "Template talk",
+    12: "Help", 13: "Help talk", 14: "Category", 15: "Category talk", 100: "Portal", 101: "Portal talk",
+    118: "Draft", 119: "Draft talk", 828: "Module", 829: "Module talk",
+}
+
+
+# The query modules the stub answers, with their parameter prefixes
+QUERY_MODULES = {
+    "prop": {"info": "in", "revisions": "rv", "categories": "cl", "categoryinfo": "ci", "pageassessments": "pa",
+             "templates": "tl"},
+    "list": {"recentchanges": "rc"},
+    "meta": {"siteinfo": "si", "userinfo": "ui", "tokens": ""},
+}
+ACTIONS = ["query", "edit", "paraminfo"]
+TEMPLATE = re.compile(r"{{\s*([^{}|#:]+?)\s*[|}]")
+
+
+# The values of a parameter, which pywikibot may give as a list or joined with "|"
+def values(parameters, name, default=()):
+    if name not in parameters:
+        return list(default)
+    return [part for value in parameters[name] for part in value.split("|")]
+
+
+# Describes an API module the way action=paraminfo does, with just enough for pywikibot
+def paraminfo_module(path):
+    if path == "main":
+        return {"name": "main", "path": "main", "classname": "ApiMain", "prefix": "", "parameters": [
+            {"name": "action", "type": ACTIONS, "submodules": {action: action for action in ACTIONS}},
+            {"name": "format", "type": ["json"], "submodules": {"json": "json"}},
+            {"name": "maxlag", "type": "integer"},
+        ]}
+    if path == "paraminfo":
+        query_modules = sorted(name for modules in QUERY_MODULES.values() for name in modules)
+        return {"name": "paraminfo", "path": "paraminfo", "classname": "ApiParamInfo", "prefix": "", "parameters": [
+            {"name": "modules", "type": "string", "multi": "", "limit": 50},
+            {"name": "querymodules", "type": query_modules, "multi": "", "limit": 50},
+        ]}
+    if path == "query":
+        parameters = [{"name": group, "type": sorted(modules), "multi": "",
+                       "submodules": {name: "query+" + name for name in modules}}
+                      for group, modules in QUERY_MODULES.items()]
+        generators = sorted(QUERY_MODULES["prop"]) + sorted(QUERY_MODULES["list"])
+        parameters.append({"name": "generator", "type": generators,
+                           "submodules": {name: "query+" + name for name in generators}})
+        for name in ("titles", "pageids", "revids"):
+            parameters.append({"name": name, "type": "string", "multi": "", "limit": 50, "highlimit": 500})
+        for name in ("redirects", "converttitles", "indexpageids", "continue", "rawcontinue"):
+            parameters.append({"name": name, "type": "boolean"})
+        return {"name": "query", "path": "query", "classname": "ApiQuery", "prefix": "", "parameters": parameters}
+    if path == "edit":
+        return {"name": "edit", "path": "edit", "classname": "ApiEditPage", "prefix": "", "mustbeposted": "",
+                "parameters": [{"name": name, "type": "string"} for name in ("title", "text", "summary", "token")]}
+    if path.startswith("query+"):
+        name = path[len("query+"):]
+        for group, modules in QUERY_MODULES.items():
+            if name in modules:
+                module = {"name": name, "path": path, "group": group, "prefix": modules[name],
+                          "classname": "ApiQuery" + name.capitalize(), "querytype": group,
+                          "parameters": [{"name": "limit", "type": "limit", "max": 500, "highmax": 5000}]}
+                if group != "meta":
+                    module["generator"] = ""
+                if name == "tokens":  # The tokens pywikibot may ask for
+                    module["parameters"].append({"name": "type", "type": ["csrf", "login"], "multi": ""})
+                if name == "info":  # Its limits are the number of pages pywikibot preloads at once
+                    module["parameters"].append({"name": "prop", "type": ["protection", "url"], "multi": "",
+                                                 "limit": 50, "highlimit": 500})
+                return module
+    return {"name": path, "path": path, "missing": ""}
+
+
+class StubWiki(object):
+    """
+    Pages, their assessments and recent changes, answered through the API.
+
+    Each page is a dict with its "title", "ns", "pageid", "revid", "text",
+    and optionally "redirect" (the target's title), "pageassessments"
+    (project: {"class": ..., "importance": ...}) and "categories".
+    """
+
+    order = 100  # Hook order, innermost, in place of the request to the wiki
+    pageassessments_limit = 2  # projects returned per request before the rest need continuing
+
+    def __init__(self, rights=("apihighlimits", "edit", "writeapi")):
+        self.lock = threading.Lock()
+        self.rights = list(rights)
+        self.pages = {}
+        self.recentchanges = []
+        self.requests = []  # The parameters of every request answered
+        self.edits = []  # (title, text, summary) of every edit made
+        self.ids = itertools.count(1)
+
+    def install(self):
+        HookRegistry.shared().add(api.Request, "submit", self.submit, self.order)
+
+    def uninstall(self):
+        HookRegistry.shared().remove(api.Request, "submit", self.submit)
+
+    def add_page(self, title, text="", redirect=None, pageassessments=None, categories=()):
+        namespace = 0
+        if ":" in title:
+            prefix = title.split(":", 1)[0]
+            namespace = next((number for number, name in NAMESPACES.items() if name == prefix), 0)
+        if redirect is not None:
+            text = "#REDIRECT [[{}]]".format(redirect)
+        page = {"title": title, "ns": namespace, "pageid": next(self.ids), "revid": next(self.ids), "text": text,
+                "redirect": redirect, "pageassessments": pageassessments or {}, "categories": list(categories)}
+        self.pages[title] = page
+        return page
+
+    def add_change(self, title, timestamp, rcid=None, change_type="new"):
+        page = self.pages.get(title) or self.add_page(title)
+        change = {"type": change_type, "ns": page["ns"], "title": title, "pageid": page["pageid"],
+                  "revid": page["revid"], "rcid": rcid or next(self.ids), "timestamp": timestamp}
+        self.recentchanges.append(change)
+        return change
+
+    # Stands in for api.Request.submit
+    def submit(self, original_submit, request):
+        # Pages are given as Page objects, which are sent as their titles
+        parameters = {name: [value.title() if isinstance(value, pywikibot.page.BasePage) else str(value)
+                             for value in request[name]] for name in request}
+        with self.lock:
+            self.requests.append(parameters)
+            action = parameters["action"][0]
+            if action == "query":
+                return self.query(parameters)
+            if action == "edit":
+                return self.edit(parameters)
+            if action == "paraminfo":
+                return {"paraminfo": {"modules": [paraminfo_module(path) for path in values(parameters, "modules")]}}
+        raise pywikibot.exceptions.APIError("badvalue", "The stub wiki can't answer action={}".format(action))
+
+    def query(self, parameters):
+        meta = values(parameters, "meta")
+        result = {}
+        if "siteinfo" in meta:
+            result.update(self.siteinfo(parameters))
+        if "userinfo" in meta:
+            result["userinfo"] = {"id": 1, "name": "StubBot", "groups": ["bot"], "rights": self.rights}
+        if "tokens" in meta:
+            result["tokens"] = {"csrftoken": "stub+\\"}
+        response = {"batchcomplete": ""}
+        if parameters.get("generator") == ["templates"]:
+            self.query_templates(parameters, result)
+        elif "titles" in parameters:
+            response.update(self.query_titles(parameters, result))
+        if "recentchanges" in values(parameters, "list"):
+            response.update(self.query_recentchanges(parameters, result))
+        response["query"] = result
+        return response
+
+    @staticmethod
+    def siteinfo(parameters):
+        namespaces = {}
+        for number, name in NAMESPACES.items():
+            namespaces[str(number)] = {"id": number, "case": "first-letter", "*": name, "canonical": name}
+            if number == 0:
+                namespaces[str(number)]["content"] = ""
+            if number > 0 and number % 2 == 1:
+                namespaces[str(number)]["subpages"] = ""
+        general = {
+            "mainpage": "Main Page", "base": "https://en.wikipedia.org/wiki/Main_Page", "sitename": "Wikipedia",
+            "generator": "MediaWiki 1.39.0", "case": "first-letter", "lang": "en", "server": "//en.wikipedia.org",
+            "servername": "en.wikipedia.org", "articlepath": "/wiki/$1", "scriptpath": "/w", "script": "/w/index.php",
+            "wikiid": "enwiki", "timezone": "UTC", "timeoffset": 0, "legaltitlechars": " %!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_`a-z~\\x80-\\xFF+",
+            "maxarticlesize": 2097152, "fallback8bitEncoding": "windows-1252", "rtl": False, "writeapi": True,
+            "linktrail": "/^([a-z]+)(.*)$/sD", "interwikimagic": True,
+        }
+        return {"general": general, "namespaces": namespaces, "namespacealiases": [], "extensions": []}
+
+    def query_titles(self, parameters, result):
+        titles = values(parameters, "titles")
+        props = values(parameters, "prop")
+        normalized = []
+        redirects = []
+        pages = []
+        for title in titles:
+            normal = title.replace("_", " ").strip()
+            normal = normal[:1].upper() + normal[1:]
+            if ":" in normal:
+                prefix, rest = normal.split(":", 1)
+                normal = prefix + ":" + rest[:1].upper() + rest[1:]
+            if normal != title:
+                normalized.append({"from": title, "to": normal})
+            page = self.pages.get(normal)
+            if page is not None and page["redirect"] and "redirects" in parameters:
+                redirects.append({"from": normal, "to": page["redirect"]})
+                normal = page["redirect"]
+                page = self.pages.get(normal)
+            pages.append(self.page_info(normal, page, props, parameters))
+
+        continued = {}
+        if "pageassessments" in props:
+            continued = self.continue_pageassessments(pages, parameters)
+        if normalized:
+            result["normalized"] = normalized
+        if redirects:
+            result["redirects"] = redirects
+        result["pages"] = {str(page.get("pageid", -index - 1)): page for index, page in enumerate(pages)}
+        return {"continue": continued} if continued else {}
+
+    # Answers generator=templates with the templates the pages transclude, which
+    # pywikibot checks for {{bots}} before saving
+    def query_templates(self, parameters, result):
+        names = set()
+        for title in values(parameters, "titles"):
+            page = self.pages.get(title)
+            if page is not None:
+                names.update(name.replace("_", " ") for name in TEMPLATE.findall(page["text"]))
+        pages = []
+        for name in sorted(set(name[:1].upper() + name[1:] for name in names)):
+            page = self.pages.get("Template:" + name)
+            pages.append(self.page_info("Template:" + name, page, values(parameters, "prop"), parameters))
+            pages[-1]["ns"] = 10
+        if pages:
+            result["pages"] = {str(page.get("pageid", -index - 1)): page for index, page in enumerate(pages)}
+
+    def page_info(self, title, page, props, parameters):
+        if page is None:
+            return {"title": title, "ns": 0, "missing": ""}
+        info = {"title": title, "ns": page["ns"], "pageid": page["pageid"]}
+        if "info" in props:
+            info.update(lastrevid=page["revid"], length=len(page["text"]), contentmodel="wikitext",
+                        touched="2024-01-01T00:00:00Z", pagelanguage="en")
+            if page["redirect"]:
+                info["redirect"] = ""
+        if "revisions" in props:
+            info["revisions"] = [{"revid": page["revid"], "parentid": 0, "user": "Example", "userid": 1,
+                                  "timestamp": "2024-01-01T00:00:00Z", "comment": "", "contentmodel": "wikitext",
+                                  "slots": {"main": {"contentmodel": "wikitext", "contentformat": "text/x-wiki",
+                                                     "*": page["text"]}}}]
+        if "categories" in props:
+            wanted = set(values(parameters, "clcategories"))
+            categories = [{"ns": 14, "title": category} for category in page["categories"] if category in wanted]
+            if categories:
+                info["categories"] = categories
+        if "pageassessments" in props and page["pageassessments"]:
+            info["pageassessments"] = dict(page["pageassessments"])
+        return info
+
+    # Like the real extension, returns at most pageassessments_limit projects
+    # per request, leaving the rest to be continued
+    def continue_pageassessments(self, pages, parameters):
+        skip = int(parameters.get("pacontinue", ["0"])[0])
+        returned = 0
+        for page in pages:
+            projects = sorted(page.pop("pageassessments", {}).items())
+            kept = {}
+            for index, (project, assessment) in enumerate(projects):
+                if returned - skip >= self.pageassessments_limit:
+                    return {"pacontinue": str(returned), "continue": "||"}
+                if returned >= skip:
+                    kept[project] = assessment
+                returned += 1
+            if kept:
+                page["pageassessments"] = kept
+        return {}
+
+    def query_recentchanges(self, parameters, result):
+        start = parameters.get("rcstart", [None])[0]
+        newer = parameters.get("rcdir", ["older"])[0] == "newer"
+        namespaces = set(int(namespace) for namespace in values(parameters, "rcnamespace"))
+        change_type = parameters.get("rctype", [None])[0]
+        limit = parameters.get("rclimit", ["10"])[0]
+        limit = 500 if limit == "max" else int(limit)
+        skip = int(parameters.get("rccontinue", ["0"])[0])
+
+        changes = sorted(self.recentchanges, key=lambda change: (change["timestamp"], change["rcid"]), reverse=not newer)
+        if start is not None:
+            changes = [change for change in changes if (change["timestamp"] >= start if newer else change["timestamp"] <= start)]
+        if namespaces:
+            changes = [change for change in changes if change["ns"] in namespaces]
+        if change_type:
+            changes = [change for change in changes if change["type"] == change_type]
+        result["recentchanges"] = [dict(change) for change in changes[skip:skip + limit]]
+        if skip + limit < len(changes):
+            return {"continue": {"rccontinue": str(skip + limit), "continue": "-||"}}
+        return {}
+
+    # pywikibot splits every parameter on "|", including the ones that only ever take one value
+    def edit(self, parameters):
+        title = "|".join(parameters["title"])
+        text = "|".join(parameters["text"])
+        page = self.pages.get(title) or self.add_page(title)
+        old_revid = page["revid"]
+        page["text"] = text
+        page["revid"] = next(self.ids)
+        self.edits.append((title, text, "|".join(parameters.get("summary", []))))
+        return {"edit": {"result": "Success", "pageid": page["pageid"], "title": title, "contentmodel": "wikitext",
+                         "oldrevid": old_revid, "newrevid": page["revid"], "newtimestamp": "2024-01-01T00:00:00Z"}}
+
+
+class StubWikiTestCase(unittest.TestCase):
+    """A test case with a StubWiki answering the requests to the default site."""
+
+    def setUp(self):
+        self.wiki = StubWiki()
+        self.wiki.install()
+        self.addCleanup(self.wiki.uninstall)
+        self.site = pywikibot.Site()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+
+import pywikibot
+from pywikibot.data import api
+
+from fireflybot import APICassette
+from stub_wiki import StubWikiTestCase
+
+
+class APICassetteTest(StubWikiTestCase):
+
+    def setUp(self):
+        super(APICassetteTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, "cassette.json.gz")
+        self.wiki.add_page("Alpha", "Some text")
+
+    def cached_request(self):
+        return api.CachedRequest(expiry=1, site=self.site, parameters={"action": "query", "titles": "Alpha", "prop": "info"})
+
+    def use_cassette(self, replay):
+        cassette = APICassette(self.filename, replay=replay)
+        cassette.install()
+        self.addCleanup(cassette.close)
+        return cassette
+
+    def test_replay(self):
+        recording = self.use_cassette(False)
+        recorded = api.Request(site=self.site, parameters={"action": "query", "titles": "Alpha"}).submit()
+        recording.close()
+
+        self.wiki.uninstall()
+        self.addCleanup(self.wiki.install)
+        self.use_cassette(True)
+        replayed = api.Request(site=self.site, parameters={"action": "query", "titles": "Alpha"}).submit()
+        self.assertEqual(replayed, recorded)
+        with self.assertRaises(pywikibot.exceptions.Error):  # Not recorded
+            api.Request(site=self.site, parameters={"action": "query", "titles": "Beta"}).submit()
+
+    def test_cached_requests_are_recorded(self):
+        request = self.cached_request()
+        expected = request.submit()  # Leaves the response in pywikibot's cache
+
+        recording = self.use_cassette(False)
+        requests_made = len(self.wiki.requests)
+        self.cached_request().submit()
+        self.assertEqual(len(self.wiki.requests), requests_made + 1)  # Sent despite the cache
+        recording.close()
+
+        # Played back somewhere whose cache is empty
+        os.remove(request._cachefile_path())
+        self.wiki.uninstall()
+        self.addCleanup(self.wiki.install)
+        self.use_cassette(True)
+        self.assertEqual(self.cached_request().submit(), expected)
@@ -0,0 +1,32 @@
+import os
+
+from stub_wiki import StubWikiTestCase
+from update_vital_article_counts import VitalArticlesBot
+
+
+DUMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "assessments.xml.bz2")
+
+
+class DumpAssessmentSourceTest(StubWikiTestCase):
+
+    def setUp(self):
+        super(DumpAssessmentSourceTest, self).setUp()
+        self.bot = VitalArticlesBot([], dump=DUMP, switchinterval=0)
+        self.addCleanup(self.bot.source.close)
+
+    def test_read_dump_qualities(self):
+        qualities = self.bot.source.read_dump_qualities(["alpha", "Delta", "Epsilon"])
+        self.assertEqual(qualities, {
+            "Alpha": ("ga", False, False),  # The highest of the talk page's assessments
+            "Delta": ("unassessed", False, False),  # No talk page in the dump
+            "Epsilon": ("dab", False, False),
+        })
+
+    def test_redirect_to_earlier_talk_page(self):
+        # Talk:Gamma comes before the redirect from Beta, so it's only found on a second pass
+        qualities = self.bot.source.read_dump_qualities(["Beta", "Alpha"])
+        self.assertEqual(qualities, {"Beta": ("fa", False, True), "Alpha": ("ga", False, False)})
+
+    def test_no_api_reads(self):
+        self.bot.source.read_dump_qualities(["Alpha", "Beta"])
+        self.assertFalse([request for request in self.wiki.requests if "titles" in request])
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import g8_patrol_bot
+from g8_patrol_bot import G8PatrolBot
+from stub_wiki import StubWikiTestCase
+
+
+class EndOfFeed(Exception):
+    pass
+
+
+class StreamTest(StubWikiTestCase):
+
+    def setUp(self):
+        super(StreamTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoint = os.path.join(self.directory, "checkpoint.json")
+        self.wiki.add_change("Talk:Older", "2024-01-01T00:00:00Z", rcid=1)
+        self.wiki.add_change("Talk:Old", "2024-01-01T00:01:00Z", rcid=2)
+
+    def make_bot(self, **options):
+        bot = G8PatrolBot([], stream=True, checkpoint=self.checkpoint, interval=0, **options)
+        bot.install_hooks()  # The stream is read without running the bot
+        self.addCleanup(lambda: bot.cassette is not None and bot.cassette.close())
+        return bot
+
+    # Reads the bot's stream. Between polls, while the bot would be sleeping, the
+    # next batch of changes is made on the wiki. The stream ends after the last batch
+    def read_stream(self, bot, batches):
+        batches = list(batches)
+
+        def sleep(seconds):
+            if not batches:
+                raise EndOfFeed
+            for title, timestamp, rcid in batches.pop(0):
+                self.wiki.add_change(title, timestamp, rcid=rcid)
+
+        titles = []
+        with mock.patch.object(g8_patrol_bot.time, "sleep", sleep):
+            try:
+                for page in bot.stream_new_talk_pages():
+                    titles.append(page.title())
+            except EndOfFeed:
+                pass
+        return titles
+
+    def read_checkpoint(self):
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def test_starts_after_newest_creation(self):
+        titles = self.read_stream(self.make_bot(), [[("Talk:A", "2024-01-01T00:02:00Z", 3)]])
+        self.assertEqual(titles, ["Talk:A"])
+
+    def test_same_timestamp(self):
+        # Changes made in the same second as ones already seen are only yielded once
+        titles = self.read_stream(self.make_bot(), [
+            [("Talk:A", "2024-01-01T00:02:00Z", 3), ("Talk:B", "2024-01-01T00:02:00Z", 4)],
+            [("Talk:C", "2024-01-01T00:02:00Z", 5), ("User talk:X", "2024-01-01T00:03:00Z", 6)],
+        ])
+        self.assertEqual(titles, ["Talk:A", "Talk:B", "Talk:C"])  # User talk pages aren't patrolled
+        self.assertEqual(self.read_checkpoint(), {"timestamp": "2024-01-01T00:02:00Z", "rcids": [3, 4, 5]})
+
+    def test_resume_from_checkpoint(self):
+        self.read_stream(self.make_bot(), [[("Talk:A", "2024-01-01T00:02:00Z", 3)]])
+        # Made while the bot wasn't running
+        self.wiki.add_change("Talk:B", "2024-01-01T00:02:00Z", rcid=4)
+        self.wiki.add_change("Talk:C", "2024-01-01T00:05:00Z", rcid=5)
+
+        del self.wiki.requests[:]
+        titles = self.read_stream(self.make_bot(), [[("Talk:D", "2024-01-01T00:06:00Z", 6)]])
+        self.assertEqual(titles, ["Talk:B", "Talk:C", "Talk:D"])
+        self.assertEqual(self.read_checkpoint(), {"timestamp": "2024-01-01T00:06:00Z", "rcids": [6]})
+        # Carried on from the checkpoint rather than asking where to start
+        self.assertFalse([request for request in self.wiki.requests if request.get("rcdir") == ["older"]])
+
+    def test_replay(self):
+        cassette = os.path.join(self.directory, "stream.json.gz")
+        bot = self.make_bot(record=cassette)
+        recorded = self.read_stream(bot, [[("Talk:A", "2024-01-01T00:02:00Z", 3)]])
+        bot.cassette.close()
+        os.remove(self.checkpoint)
+
+        # Nothing is left on the wiki, so every answer has to come from the cassette
+        self.wiki.uninstall()
+        self.addCleanup(self.wiki.install)
+        replayed = self.read_stream(self.make_bot(replay=cassette), [[]])
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayed, ["Talk:A"])
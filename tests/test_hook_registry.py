@@ -0,0 +1,57 @@
+import itertools
+import unittest
+
+from fireflybot import HookRegistry
+
+
+class Owner(object):
+
+    @staticmethod
+    def function(calls):
+        calls.append("original")
+        return "result"
+
+
+original = Owner.function
+
+
+# Makes a hook that notes its name in the calls before passing the call on
+def make_hook(name):
+    def hook(call, calls):
+        calls.append(name)
+        return call(calls)
+    return hook
+
+
+class HookRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = HookRegistry()
+        self.hooks = {"outer": make_hook("outer"), "middle": make_hook("middle"), "inner": make_hook("inner")}
+
+    def add_hooks(self):
+        # Added out of order, but called from the lowest order inwards
+        self.registry.add(Owner, "function", self.hooks["inner"], 30)
+        self.registry.add(Owner, "function", self.hooks["outer"], 10)
+        self.registry.add(Owner, "function", self.hooks["middle"], 20)
+
+    def call(self):
+        calls = []
+        self.assertEqual(Owner.function(calls), "result")
+        return calls
+
+    def test_order(self):
+        self.add_hooks()
+        self.addCleanup(setattr, Owner, "function", staticmethod(original))
+        self.assertEqual(self.call(), ["outer", "middle", "inner", "original"])
+
+    def test_remove_in_any_order(self):
+        for removal_order in itertools.permutations(self.hooks):
+            self.add_hooks()
+            remaining = ["outer", "middle", "inner"]
+            for name in removal_order:
+                self.registry.remove(Owner, "function", self.hooks[name])
+                remaining.remove(name)
+                self.assertEqual(self.call(), remaining + ["original"])
+            self.assertIs(Owner.function, original)
+            self.assertEqual(self.registry.chains, {})
@@ -0,0 +1,183 @@
+import random
+import re
+from itertools import groupby
+
+import mwparserfromhell
+
+from stub_wiki import StubWikiTestCase
+from update_vital_article_counts import VitalArticlesBot
+
+
+# How the section headers were updated before update_section_counts(), from get_sections()
+def old_update_section_counts(wikicode):
+    for section in wikicode.get_sections(include_lead=False):
+        article_count = section.count("# {{Icon") + section.count("# {{icon")
+        if article_count == 0:
+            article_count = section.count("* {{Icon") + section.count("* {{icon")
+        old_header_match = re.match(r"(=+)\s*(.+?)\s*[\(:]\s*?([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)?\s*=+", str(section))
+        if old_header_match is None:
+            continue
+        old_header = old_header_match.group(0)
+        has_quota = "quota" in str(section)
+        old_header_groups = old_header_match.groups()
+        use_colon = "current total" in old_header.lower() and ":" in old_header
+        new_header = "{0}{1} {6}{2}{4} article{3}{5}{7}{0}".format(old_header_groups[0],
+                                                            old_header_groups[1],
+                                                            article_count,
+                                                            "" if article_count == 1 or has_quota else "s",
+                                                            old_header_groups[3] if len(old_header_groups) > 3 and old_header_groups[3] is not None else "",
+                                                            " quota" if has_quota else "",
+                                                            ":" if use_colon else "(",
+                                                            "" if use_colon else ")")
+
+        new_header = new_header.replace("article quota", "quota")
+        if old_header_match.group(0).replace(",","") != new_header:
+            section.replace(old_header_match.group(0), new_header)
+
+
+# and the 'total articles' count
+def old_update_total_count(wikicode):
+    total_count = 0
+    for i in range(1,10):
+        top_level_sections = wikicode.get_sections(levels=[i])
+        if len(top_level_sections) > 0:
+            for section in top_level_sections:
+                heading = str(section.filter_headings()[0])
+                heading_match = re.search(r"([0-9,]+)\s*(?:articles?)?\s*(/\s*[0-9,]+)?\s*(?:articles?| quota)?\)", heading)
+                if heading_match is None:
+                    continue
+                total_count += int(heading_match.group(1).replace(",",""))
+            break
+
+    for template in wikicode.filter_templates():
+        if template.name.matches("huge"):
+            denominator = ""
+            param = template.get("1")
+            if "/" in param:
+                denominator = "/{}".format(param.split("/")[-1].strip("'"))
+            template.add("1", "Total articles: {}{}".format(total_count, denominator))
+
+
+# How the lines were found, by grouping every node on the page
+def old_get_lines(wikicode):
+    return [list(group) for k, group in groupby(wikicode.filter(), lambda x: "\n" in x) if not k]
+
+
+# and how their icons were updated, editing the page as each line was checked. Two
+# kinds of line used to crash the bot, and are now updated as if the line's icons
+# were only removed after any new ones had been added: a DGA or FFA article with no
+# icon, which is left alone, and a new icon that goes after one being removed
+def old_update_assessments(bot, wikicode, qualities):
+    for line in old_get_lines(wikicode):
+        if line[0] == "#" or line[0] == "*":
+            article_title = bot.get_article_link(line)
+            if article_title is None or "Wikipedia:" in article_title or "Category:" in article_title or "User:" in article_title or "Template:" in article_title or "Portal:" in article_title:
+                continue
+            article_assessment, is_dga, is_ffa = qualities[article_title]
+
+            count = 0
+            dga_found = False
+            ffa_found = False
+            first_templ = None
+            removed = []
+            for item in line:
+                if "{{icon" in item.lower():
+                    first_templ = item
+                    try:
+                        existing_assessment = item.get("1").lower()
+                    except ValueError:  # Template may not have parameters
+                        continue
+                    if existing_assessment != article_assessment and existing_assessment not in bot.no_replace_list and count < 1:
+                        item.add("1", article_assessment.title())
+                    dga_found |= (existing_assessment == "dga")
+                    ffa_found |= (existing_assessment == "ffa")
+
+                    if (dga_found and article_assessment == "ga") or \
+                        (ffa_found and article_assessment == "fa"):
+                        removed.append(item)
+                    count += 1
+
+            if first_templ is None:
+                continue
+            if (is_dga and not dga_found):
+                wikicode.insert_after(first_templ, " {{icon|DGA}}")
+            if (is_ffa and not ffa_found):
+                wikicode.insert_after(first_templ, " {{icon|FFA}}")
+            for item in removed:
+                wikicode.remove(item)
+
+
+HEADERS = [
+    "{0} {1} ({2} articles) {0}", "{0}{1} ({2} article){0}", "{0} {1} ({2}/{3} quota) {0}", "{0} {1} ({2}/{3} articles) {0}",
+    "{0} {1}, current total: {2} {0}", "{0} {1} {0}", "{0} {1} ({2:,} articles) {0}", "{0} {1} ({2} articles) {0} <!-- note -->",
+]
+ICONS = ["FA", "fa", "FL", "A", "GA", "ga", "B", "C", "Start", "Stub", "List", "DGA", "FFA", "Dab"]
+LINES = [
+    "{b} {{{{Icon|{i}}}}} [[{t}]]", "{b} {{{{icon|{i}}}}} [[{t}|{t} (label)]]", "{b}{b} {{{{Icon|{i}}}}} {{{{Icon|{j}}}}} [[{t}]]",
+    "{b} {{{{Icon|{i}}}}} ''[[{t}]]''", "{b} [[{t}]]", "{b} {{{{Icon}}}} [[{t}]]", "{b} {{{{Icon|{i}}}}} [[Wikipedia:{t}]]",
+    "{b} {{{{Icon|{i}}}}} [[{t}]] <small>(also [[Other]])</small>", "{b}{{{{Icon|{i}}}}} [[{t}]]", "{b} {{{{Icon|{i}}}}} {{{{Icon|FFA}}}} [[{t}]]",
+    "Some text about [[{t}]].", "<!-- {b} {{{{Icon|{i}}}}} [[{t}]] -->",
+]
+
+
+# Makes a list page mixing the header, line and template styles found on the real pages
+def generate_list_page(rng):
+    lines = ["{{Vital articles|level=5}}", rng.choice(["{{huge|'''Total articles: 0/50,000'''}}", "{{huge|Total articles: 5}}", ""]), ""]
+    titles = []
+    for section in range(rng.randint(0, 8)):
+        level = rng.choice([2, 2, 3, 4])
+        lines.append(rng.choice(HEADERS).format("=" * level, "Section {}".format(section), rng.randint(0, 2000), rng.randint(0, 500)))
+        columns = rng.random() < 0.2
+        if columns:
+            lines.append("{{columns-list|colwidth=30em|")
+        bullet = rng.choice(["#", "*"])
+        for i in range(rng.randint(0, 12)):
+            title = "Article {}".format(len(titles))
+            titles.append(title)
+            lines.append(rng.choice(LINES).format(b=bullet, i=rng.choice(ICONS), j=rng.choice(ICONS), t=title))
+        if columns:
+            lines.append("}}")
+        if rng.random() < 0.3:
+            lines.append("")
+    return "\n".join(lines), titles
+
+
+class ListPageParityTest(StubWikiTestCase):
+
+    page_count = 200
+
+    def setUp(self):
+        super(ListPageParityTest, self).setUp()
+        self.bot = VitalArticlesBot([], switchinterval=0)
+        self.addCleanup(self.bot.source.close)
+
+    def pages(self, seed):
+        rng = random.Random(seed)
+        for i in range(self.page_count):
+            yield generate_list_page(rng) + (rng,)
+
+    def test_section_counts(self):
+        for text, titles, rng in self.pages(5):
+            old = mwparserfromhell.parse(text, skip_style_tags=True)
+            old_update_section_counts(old)
+            old_update_total_count(old)
+            new = mwparserfromhell.parse(text, skip_style_tags=True)
+            self.bot.update_section_counts(new)
+            self.bot.update_total_count(new)
+            self.assertEqual(str(new), str(old), text)
+
+    def test_lines(self):
+        for text, titles, rng in self.pages(6):
+            wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
+            self.assertEqual([[str(node) for node in line] for line in self.bot.get_lines(wikicode)],
+                             [[str(node) for node in line] for line in old_get_lines(wikicode)], text)
+
+    def test_assessments(self):
+        for text, titles, rng in self.pages(7):
+            qualities = {title: (rng.choice(self.bot.assessment_order), rng.random() < 0.2, rng.random() < 0.2) for title in titles}
+            self.bot.get_vital_article_qualities = lambda page_titles: {title: qualities[title] for title in page_titles}
+            old = mwparserfromhell.parse(text, skip_style_tags=True)
+            old_update_assessments(self.bot, old, qualities)
+            new = mwparserfromhell.parse(text, skip_style_tags=True)
+            self.bot.update_assessments(new)
+            self.assertEqual(str(new), str(old), text)
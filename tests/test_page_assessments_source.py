@@ -0,0 +1,47 @@
+from stub_wiki import StubWikiTestCase
+from update_vital_article_counts import PageAssessmentsSource, VitalArticlesBot
+
+
+class PageAssessmentsSourceTest(StubWikiTestCase):
+
+    def setUp(self):
+        super(PageAssessmentsSourceTest, self).setUp()
+        self.wiki.pageassessments_limit = 2  # So Alpha's projects take two requests
+        self.wiki.add_page("Alpha", pageassessments={
+            "History": {"class": "Start", "importance": "Low"},
+            "Mathematics": {"class": "C", "importance": "Mid"},
+            "Physics": {"class": "B+", "importance": "High"},  # Only returned once the query is continued
+        })
+        self.wiki.add_page("Talk:Alpha", categories=[PageAssessmentsSource.dga_category, "Category:Unrelated"])
+        self.wiki.add_page("Beta", pageassessments={"Disambiguation": {"class": "Disambig", "importance": ""}})
+        self.wiki.add_page("Talk:Beta", categories=[PageAssessmentsSource.dga_category])
+        self.wiki.add_page("Gamma", redirect="Delta")
+        self.wiki.add_page("Delta", pageassessments={"Chemistry": {"class": "FA", "importance": "Top"}})
+        self.wiki.add_page("Talk:Delta", categories=[PageAssessmentsSource.ffa_category])
+        self.wiki.add_page("Zeta", pageassessments={"Biology": {"class": "Vandalised", "importance": "Top"}})
+
+        self.bot = VitalArticlesBot([], source="pageassessments", switchinterval=0)
+        self.addCleanup(self.bot.source.close)
+
+    def test_get_assessments(self):
+        qualities = self.bot.source.get_assessments(["alpha", "Beta", "Gamma", "Epsilon", "Zeta"])
+        self.assertEqual(qualities, {
+            "alpha": ("bplus", True, False),  # B+ from the continued request, delisted GA from the categories
+            "Beta": ("dab", False, False),  # Not assessed, so the category is never asked for
+            "Gamma": ("fa", False, True),  # Through the redirect to Delta
+            "Epsilon": ("unassessed", False, False),  # Missing
+            "Zeta": ("unassessed", False, False),  # Not a class the bot knows
+        })
+
+    def test_requests(self):
+        self.bot.source.get_assessments(["Alpha", "Beta", "Gamma"])
+        queries = [request for request in self.wiki.requests if "titles" in request]
+        assessment_queries = [request for request in queries if request.get("prop") == ["pageassessments"]]
+        # Five projects, two to a request
+        self.assertEqual([request.get("pacontinue") for request in assessment_queries], [None, ["2"], ["4"]])
+
+        category_queries = [request for request in queries if request.get("prop") == ["categories"]]
+        self.assertEqual(len(category_queries), 1)
+        self.assertEqual(sorted(category_queries[0]["titles"]), ["Talk:Alpha", "Talk:Delta"])
+        self.assertEqual(sorted(category_queries[0]["clcategories"]),
+                         sorted([PageAssessmentsSource.dga_category, PageAssessmentsSource.ffa_category]))
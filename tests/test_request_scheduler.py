@@ -0,0 +1,158 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pywikibot.data import api
+
+import fireflybot
+from fireflybot import HookRegistry, RequestScheduler
+from stub_wiki import StubWikiTestCase
+
+
+class QueryMergingTest(StubWikiTestCase):
+
+    # Titles queried by each thread. The first thread's query is held up on its
+    # way to the wiki until the others have all queued up behind it
+    thread_titles = [["Zero"], ["alpha"], ["Gamma"], ["Delta"], ["Page 4", "Page 5"], ["Missing"], ["Page 6"], ["Page 7"]]
+
+    def setUp(self):
+        super(QueryMergingTest, self).setUp()
+        for title in ["Zero", "Alpha", "Delta", "Page 4", "Page 5", "Page 6", "Page 7"]:
+            self.wiki.add_page(title)
+        self.wiki.add_page("Gamma", redirect="Delta")
+        self.scheduler = RequestScheduler()
+        self.release = threading.Event()
+        HookRegistry.shared().add(api.Request, "submit", self.hold_first_query, 50)
+        self.addCleanup(HookRegistry.shared().remove, api.Request, "submit", self.hold_first_query)
+        self.held = False
+
+    def hold_first_query(self, submit, request):
+        if "titles" in request and not self.held:
+            self.held = True
+            self.release.wait(5)
+        return submit(request)
+
+    def queued_count(self):
+        with self.scheduler.lock:
+            return sum(len(waiters) for waiters in self.scheduler.queued.values())
+
+    def test_queued_queries_are_merged(self):
+        results = {}
+
+        def query(index):
+            results[index] = self.scheduler.query(self.site, self.thread_titles[index], {"redirects": True}, 50)
+
+        threads = [threading.Thread(target=query, args=(0,))]
+        threads[0].start()
+        deadline = time.time() + 5
+        while not self.held and time.time() < deadline:
+            time.sleep(0.01)
+        threads.extend(threading.Thread(target=query, args=(index,)) for index in range(1, len(self.thread_titles)))
+        for thread in threads[1:]:
+            thread.start()
+        while self.queued_count() < len(self.thread_titles) - 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+        title_queries = [request["titles"] for request in self.wiki.requests if "titles" in request]
+        self.assertEqual(len(title_queries), 2)
+        self.assertEqual(title_queries[0], ["Zero"])
+        self.assertEqual(sorted(title_queries[1]), sorted(title for titles in self.thread_titles[1:] for title in titles))
+
+        # Each thread only gets back what it asked for
+        def page_titles(index):
+            return sorted(page["title"] for part in results[index] for page in part["pages"].values())
+
+        self.assertEqual(page_titles(1), ["Alpha"])
+        self.assertEqual(results[1][0]["normalized"], [{"from": "alpha", "to": "Alpha"}])
+        self.assertEqual(page_titles(2), ["Delta"])
+        self.assertEqual(results[2][0]["redirects"], [{"from": "Gamma", "to": "Delta"}])
+        self.assertEqual(page_titles(3), ["Delta"])
+        self.assertEqual(results[3][0].get("redirects"), [])
+        self.assertEqual(page_titles(4), ["Page 4", "Page 5"])
+        self.assertEqual(page_titles(5), ["Missing"])
+        self.assertEqual(self.scheduler.queued, {})
+        self.assertEqual(self.scheduler.sending, set())
+
+    def test_full_batch_sent_straight_away(self):
+        self.release.set()
+        parts = self.scheduler.query(self.site, ["Page 4", "Page 5"], {}, 2)
+        self.assertEqual(sorted(page["title"] for page in parts[0]["pages"].values()), ["Page 4", "Page 5"])
+        self.assertEqual(self.scheduler.queued, {})
+
+
+class SplitQueryTest(unittest.TestCase):
+
+    def test_follows_normalisation_and_redirects(self):
+        parts = [{
+            "normalized": [{"from": "alpha", "to": "Alpha"}, {"from": "beta", "to": "Beta"}],
+            "redirects": [{"from": "Alpha", "to": "Alpha (letter)"}, {"from": "Gamma", "to": "Delta"}],
+            "pages": {"1": {"title": "Alpha (letter)"}, "2": {"title": "Beta"}, "3": {"title": "Delta"}},
+        }]
+        split = RequestScheduler.split_query(parts, ["alpha"])
+        self.assertEqual(split, [{
+            "normalized": [{"from": "alpha", "to": "Alpha"}],
+            "redirects": [{"from": "Alpha", "to": "Alpha (letter)"}],
+            "pages": {"1": {"title": "Alpha (letter)"}},
+        }])
+        self.assertEqual(len(parts[0]["pages"]), 3)  # The merged query is left as it was
+
+    def test_formatversion_2(self):
+        parts = [{"pages": [{"title": "Alpha"}, {"title": "Beta"}]}, {"pages": [{"title": "Beta"}]}]
+        self.assertEqual(RequestScheduler.split_query(parts, ["Beta"]), [{"pages": [{"title": "Beta"}]}, {"pages": [{"title": "Beta"}]}])
+
+
+class Throttle(object):
+    retry_after = 0
+
+
+class BackoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = RequestScheduler()
+        self.sleeps = []
+        patcher = mock.patch.object(fireflybot.time, "sleep", self.sleeps.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def submit(self):
+        self.scheduler.submit_hook(lambda request: {}, None)
+
+    def test_widens_and_narrows(self):
+        self.scheduler.wait_hook(lambda request, delay: None, None, 5)  # A retry after 5 seconds
+        self.assertEqual(self.scheduler.limiter.delay, 5)
+        self.scheduler.wait_hook(lambda request, delay: None, None, 5)
+        self.assertEqual(self.scheduler.limiter.delay, 10)  # Doubled by a second retry
+
+        throttle = Throttle()
+        throttle.retry_after = 30
+        self.scheduler.lag_hook(lambda throttle, lagtime: None, throttle, 2)
+        self.assertEqual(self.scheduler.limiter.delay, 30)  # As long as Retry-After asks
+        throttle.retry_after = 0
+        self.scheduler.lag_hook(lambda throttle, lagtime: None, throttle, lagtime=2)
+        self.assertEqual(self.scheduler.limiter.delay, 60)
+
+        # Every request waits its turn after a backoff, and each success halves the gap
+        self.submit()
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertEqual(self.scheduler.limiter.delay, 30)
+        self.submit()
+        self.assertEqual(self.scheduler.limiter.delay, 15)
+        for i in range(20):
+            self.submit()
+        self.assertLess(self.scheduler.limiter.delay, 0.001)
+
+    def test_max_delay(self):
+        for i in range(20):
+            self.scheduler.wait_hook(lambda request, delay: None, None, 100)
+        self.assertEqual(self.scheduler.limiter.delay, self.scheduler.limiter.max_delay)
+
+    def test_max_rate(self):
+        self.scheduler.limit(4)
+        self.scheduler.wait_hook(lambda request, delay: None, None, 1)
+        for i in range(20):
+            self.submit()
+        self.assertEqual(self.scheduler.limiter.delay, 0.25)  # Never narrower than -maxrate allows
@@ -0,0 +1,140 @@
+import random
+import unittest
+
+import mwparserfromhell
+
+from update_vital_article_counts import VitalArticlesBot, scan_templates
+
+
+# How assessments were read before scan_templates(), with a full parse of every talk page
+def old_assess_talk_page_text(bot, text):
+
+    def sanitise_assessment(ass):
+        ass = ass.lower()
+        return ass.split("<!")[0].strip()
+
+    assessments = []
+    talk_wikicode = mwparserfromhell.parse(text)
+
+    is_dga = False
+    is_ffa = False
+
+    for template in talk_wikicode.filter_templates():
+        template_name_lower = template.name.lower()
+
+        if template_name_lower in bot.dga_templates:
+            is_dga = True
+        elif template_name_lower in bot.article_history_templates:
+            try:
+                cur_status = template.get("currentstatus").split("=")[1].strip()
+                is_dga = cur_status.lower() == "dga"
+                is_ffa = cur_status.lower() == "ffa"
+            except ValueError:
+                pass
+            continue
+
+        try:
+            assessment = sanitise_assessment(template.get("class").split("=")[1])
+            if assessment in bot.assessment_order:
+                assessments.append(assessment)
+        except ValueError:
+            continue
+
+    if len(assessments) == 0:
+        if "WikiProject Disambiguation" in text:
+            return "dab", False, False
+        else:
+            return "unassessed", False, False
+    elif len(assessments) > 1:
+        assessments.sort(key=lambda x: bot.assessment_order.index(x) if x in bot.assessment_order else 255)
+    return assessments[0], is_dga, is_ffa
+
+
+# Pieces of talk page markup that random talk pages are made from
+FRAGMENTS = [
+    "{{", "}}", "{{WikiProject X", "{{WikiProject Y ", "|class=", "B", "GA", "fa", "Start", "|", "=", "[[", "]]",
+    "[[Foo|bar]]", "\n", " ", "<!-- c -->", "<!--", "-->", "{{ArticleHistory", "{{Article history\n",
+    "|currentstatus=", "DGA", "FFA", "{{dga}}", "{{DelistedGA}}", "<small>", "</small>", "[", "]", "{", "}",
+    "text ", "class", "{{WikiProject banner shell|1=\n", "<nowiki>", "</nowiki>", "{{{", "}}}", "{{=}}",
+    "WikiProject Disambiguation", "[http://x a|b]", "~~~~", "'''", "<ref>", "</ref>", "{|", "|}", "|-", "==h==",
+    "\n==x==\n", "stub<!-- x -->",
+]
+
+TALK_PAGE = """{{Talk header}}
+{{WikiProject banner shell|class=B|vital=yes|1=
+{{WikiProject Biology|importance=High}}
+{{WikiProject Chemistry|class=GA<!-- reassessed 2019 -->|importance=Mid}}
+}}
+{{ArticleHistory|action1=GAN
+|action1result=listed
+|currentstatus=DGA
+}}
+{{Archives|[[/Archive 1|1]]}}
+
+== A thread ==
+Some discussion, with a [[link|piped link]] and {{tq|a quote}}. ~~~~
+"""
+
+
+class ScanTemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = VitalArticlesBot.__new__(VitalArticlesBot)  # Only the class's template lists are needed
+
+    def assert_same_templates(self, text):
+        templates = scan_templates(text)
+        self.assertIsNotNone(templates, text)
+        # Positional parameters are never needed, so they are left out
+        expected = [(str(template.name), {str(param.name).strip(): str(param) for param in template.params if param.showkey})
+                    for template in mwparserfromhell.parse(text).filter_templates()]
+        self.assertEqual(templates, expected)
+
+    def assert_same_assessment(self, text):
+        self.assertEqual(self.bot.assess_talk_page_text(text), old_assess_talk_page_text(self.bot, text), text)
+
+    def test_talk_page(self):
+        self.assert_same_templates(TALK_PAGE)
+        self.assert_same_assessment(TALK_PAGE)
+        self.assertEqual(self.bot.assess_talk_page_text(TALK_PAGE), ("ga", True, False))
+
+    def test_random_talk_pages(self):
+        rng = random.Random(4)
+        scanned = 0
+        for _ in range(5000):
+            text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 30)))
+            self.assert_same_assessment(text)
+            if scan_templates(text) is not None:
+                self.assert_same_templates(text)
+                scanned += 1
+        self.assertGreater(scanned, 500)  # Most pages shouldn't need the full parser
+
+    def test_stray_markup(self):
+        # Markup outside templates can't change them, so it's scanned as usual
+        for text in ["{{WikiProject X|class=B}}}}", "]] {{WikiProject X|class=B}} [[", "<!-- c -->{{WikiProject X|class=B}}"]:
+            self.assert_same_templates(text)
+            self.assert_same_assessment(text)
+
+    def test_fallbacks(self):
+        # Markup that scan_templates() leaves to mwparserfromhell
+        texts = [
+            "{{WikiProject X|class={{{1|B}}}}}",  # Template parameters
+            "{{WikiProject X|class=B}}<nowiki>{{WikiProject Y|class=FA}}</nowiki>",
+            "<nowiki>{{WikiProject X|class=FA}}",  # An unclosed unparsed tag
+            "{{WikiProject X|class=B",  # Unbalanced braces
+            "{{WikiProject X|class=[[B}}",  # Unbalanced brackets
+            "{{WikiProject X|class=B]]}}",
+            "{{WikiProject X|class=[B}}",
+            "{{WikiProject <!-- old name -->X|class=GA}}",  # Comments in names
+            "{{<!-- c -->WikiProject X|class=GA}}",
+            "{{WikiProject X|class=B}}<!-- {{WikiProject Y|class=FA}}",  # An unclosed comment
+            "{{WikiProject X|<small>class</small>=B}}",
+            "{{WikiProject X|class='''B'''}}",
+            "{{WikiProject X|class=B\n==Heading==\n}}",
+        ]
+        for text in texts:
+            self.assertIsNone(scan_templates(text), text)
+            self.assert_same_assessment(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+from unittest import mock
+
+import fireflybot
+from fireflybot import BotMetrics, TaskSwitchWatcher
+from stub_wiki import StubWikiTestCase
+
+
+class Task(object):
+
+    def __init__(self):
+        self.metrics = BotMetrics(self)
+
+
+class TaskSwitchWatcherTest(StubWikiTestCase):
+
+    title = "User:Bot0612/shutoff/9"
+
+    def setUp(self):
+        super(TaskSwitchWatcherTest, self).setUp()
+        self.wiki.add_page(self.title, "active")
+        self.task = Task()
+        self.watcher = TaskSwitchWatcher(self.site, self.title, interval=60, task=self.task)
+
+    def test_refresh(self):
+        self.watcher.refresh()
+        self.assertTrue(self.watcher.is_on)
+        self.assertEqual(self.task.metrics.phases["task_switch_check"][1], 1)
+
+        self.watcher.refresh()  # Unchanged, so only the revision ID is looked up
+        self.assertEqual(len([request for request in self.wiki.requests if request.get("prop") == ["info"]]), 2)
+        self.assertEqual(self.task.metrics.phases["task_switch_check"][1], 2)
+
+        self.wiki.add_page(self.title, "inactive")
+        self.watcher.refresh()
+        self.assertFalse(self.watcher.is_on)
+
+    def test_off_once_stale(self):
+        self.watcher.refresh()
+        now = self.watcher.refreshed
+        with mock.patch.object(fireflybot.time, "time", lambda: now + 3 * 60):
+            self.assertTrue(self.watcher.is_on)
+        with mock.patch.object(fireflybot.time, "time", lambda: now + 3 * 60 + 1):
+            self.assertFalse(self.watcher.is_on)  # Not checked for three intervals